@@ -0,0 +1,745 @@
+# db.py — общий слой доступа к SQLite для бота и веб-админки
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("BOOKING_DB_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "booking.db"
+)
+DB_WORKERS = int(os.getenv("DB_WORKERS", "2"))  # потоки, выполняющие запросы для asyncio-кода
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(DB_WORKERS + 2)))  # максимум соединений на процесс
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # сколько ждать свободное соединение, прежде чем упасть
+DB_BUSY_TIMEOUT_MS = 5000  # сколько ждать блокировку, прежде чем вернуть "database is locked"
+DB_CACHE_SIZE_KB = 8192  # кэш страниц на соединение
+STATEMENT_CACHE_SIZE = 128  # подготовленные выражения, которые sqlite3 держит на соединение
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "5"))  # сколько собирать записи в одну транзакцию
+GROUP_COMMIT_MAX_OPS = int(os.getenv("GROUP_COMMIT_MAX_OPS", "64"))  # и не больше стольких операций
+
+
+# --- Сколько ждали: блокировку записи (BEGIN IMMEDIATE), соединение из пула, поток БД, групповой коммит ---
+class WaitStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'count': self.count, 'total': self.total, 'max': self.max}
+
+
+wait_stats = {
+    'begin_immediate': WaitStats(),
+    'pool': WaitStats(),
+    'executor': WaitStats(),
+    'group_commit': WaitStats(),
+}
+
+
+def _wait_stats_lines() -> list:
+    lines = [
+        "# HELP db_wait_seconds_total Ожидание БД: блокировка записи, соединение из пула, поток БД, групповой коммит",
+        "# TYPE db_wait_seconds_total counter",
+    ]
+    snapshots = {name: stats.snapshot() for name, stats in wait_stats.items()}
+    lines += [f'db_wait_seconds_total{{kind="{name}"}} {snap["total"]}' for name, snap in snapshots.items()]
+    lines += ["# HELP db_waits_total Сколько раз ждали", "# TYPE db_waits_total counter"]
+    lines += [f'db_waits_total{{kind="{name}"}} {snap["count"]}' for name, snap in snapshots.items()]
+    return lines
+
+
+metrics.register_collector(_wait_stats_lines)
+
+
+# --- Соединение, которое замеряет каждый запрос ---
+# Имя запроса — функция, из которой он вызван, и его тип (SELECT, INSERT, BEGIN...):
+# без разметки каждого SQL видно, какой шаг медленный. Время — до первой строки результата.
+_statement_kinds = {}
+
+
+def _statement_kind(sql: str) -> str:
+    kind = _statement_kinds.get(sql)
+    if kind is None:
+        if len(_statement_kinds) > 1000:
+            _statement_kinds.clear()
+        kind = _statement_kinds[sql] = (sql.split(None, 1) or ['?'])[0].upper()
+    return kind
+
+
+class TimedConnection(sqlite3.Connection):
+    def execute(self, sql, parameters=(), /):
+        caller = sys._getframe(1).f_code.co_name
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.sql_seconds.observe(time.perf_counter() - started, statement=caller, kind=_statement_kind(sql))
+
+    def executemany(self, sql, parameters, /):
+        caller = sys._getframe(1).f_code.co_name
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            metrics.sql_seconds.observe(time.perf_counter() - started, statement=caller, kind=_statement_kind(sql))
+
+
+# --- Новое соединение с настроенными PRAGMA ---
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        path,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,  # транзакциями управляем сами через transaction()
+        check_same_thread=False,  # соединение ходит между потоками, но только через пул
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=TimedConnection,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+# --- Ограниченный пул долгоживущих соединений ---
+class ConnectionPool:
+    def __init__(self, path: str, size: int = DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def acquire(self, timeout: float = DB_POOL_TIMEOUT) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return _connect(self.path)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        started = time.perf_counter()
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"Нет свободных соединений с БД (пул из {self.size})")
+        finally:
+            wait_stats['pool'].add(time.perf_counter() - started)
+
+    def release(self, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+        except sqlite3.Error:
+            # Соединение в неизвестном состоянии — не возвращаем его в пул
+            self._discard(conn)
+            return
+        self._idle.put_nowait(conn)
+
+    def _discard(self, conn: sqlite3.Connection):
+        conn.close()
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self, timeout: float = DB_POOL_TIMEOUT):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.execute("PRAGMA optimize")  # обновить статистику индексов, если устарела
+            except sqlite3.Error:
+                pass
+            self._discard(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# --- Пул текущего процесса (после fork создаётся заново) ---
+def get_pool() -> ConnectionPool:
+    global _pool
+    pool = _pool
+    if pool is not None and pool.path == DB_PATH and pool._pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DB_PATH or _pool._pid != os.getpid():
+            if _pool is not None and _pool._pid == os.getpid():
+                _pool.close()
+            _pool = ConnectionPool(DB_PATH)
+            logger.info(f"Пул соединений с БД: {DB_PATH} (до {_pool.size} соединений)")
+        return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+# --- Соединение из пула (autocommit для чтения) ---
+@contextmanager
+def connection():
+    with get_pool().connection() as conn:
+        yield conn
+
+
+# --- Транзакция: COMMIT при успехе, ROLLBACK при ошибке ---
+@contextmanager
+def transaction(immediate: bool = False):
+    with connection() as conn:
+        if immediate:
+            # Здесь ждём, пока другой писатель (поток или процесс) отпустит базу
+            started = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            wait_stats['begin_immediate'].add(time.perf_counter() - started)
+        else:
+            conn.execute("BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# --- Потоки для запросов из asyncio (event loop не ждёт диск) ---
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+    return _executor
+
+
+# --- Выполнить синхронную функцию БД в пуле потоков и дождаться результата ---
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+
+    def call():
+        wait_stats['executor'].add(time.perf_counter() - submitted)  # очередь к потокам БД
+        return func(*args, **kwargs)
+
+    return await loop.run_in_executor(get_executor(), call)
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+# --- Групповой коммит: записи из обработчиков копятся и применяются одной транзакцией ---
+# Операция — функция op(conn, *args), которая пишет через переданное соединение и не коммитит.
+# Каждая выполняется в своём SAVEPOINT: ошибка одной откатывает только её, и вызывающий
+# получает эту ошибку, а остальные — свои результаты. Порядок операций сохраняется.
+# Писатель — отдельный поток, а не задача asyncio: под нагрузкой event loop занят обработчиками,
+# и каждое пробуждение задачи-писателя стояло бы в очереди за ними.
+class GroupCommitWriter:
+    def __init__(self, window_ms: float = GROUP_COMMIT_WINDOW_MS, max_ops: int = GROUP_COMMIT_MAX_OPS):
+        self.window = window_ms / 1000
+        self.max_ops = max_ops
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    async def start(self):
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+        logger.info(f"Групповой коммит: окно {self.window * 1000:.0f} мс, до {self.max_ops} операций")
+
+    # Дописать всё, что уже в очереди, и остановиться
+    async def stop(self):
+        thread, self._thread = self._thread, None  # новые submit() уже не принимаются
+        if thread is not None:
+            self._queue.put(None)
+            await asyncio.to_thread(thread.join)
+
+    async def submit(self, op, *args):
+        if self._thread is None:
+            raise RuntimeError("Групповой коммит не запущен или уже остановлен")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((op, args, loop, future, time.perf_counter()))
+        return await future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_ops:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch: list):
+        try:
+            results = self._apply(batch)
+        except Exception as e:
+            # Не удалась вся транзакция (например, база занята дольше busy_timeout)
+            results = [e] * len(batch)
+        for (_, _, loop, future, _), result in zip(batch, results):
+            loop.call_soon_threadsafe(_resolve_future, future, result)
+
+    def _apply(self, batch: list) -> list:
+        results = []
+        with transaction(immediate=True) as conn:
+            started = time.perf_counter()
+            for op, args, _, _, submitted in batch:
+                wait_stats['group_commit'].add(started - submitted)
+                conn.execute("SAVEPOINT group_op")
+                try:
+                    results.append(op(conn, *args))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO group_op")
+                    results.append(e)
+                conn.execute("RELEASE group_op")
+        metrics.group_commit_ops.observe(len(batch))
+        return results
+
+
+def _resolve_future(future: asyncio.Future, result):
+    if future.done():  # вызывающего отменили — запись всё равно применена
+        return
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+# --- Миграции схемы ---
+# Каждая миграция выполняется один раз в своей транзакции, номер версии
+# хранится в PRAGMA user_version. Новые шаги добавляются только в конец списка.
+
+
+def _migration_base_schema(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            specialization TEXT,
+            direction TEXT,
+            instrument TEXT,
+            date TEXT,
+            time_slot TEXT,
+            status TEXT DEFAULT 'pending_payment',
+            payment_id TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            paid_at DATETIME,
+            price REAL NOT NULL DEFAULT 800.0
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS prices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            specialization TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            price REAL NOT NULL DEFAULT 800.0,
+            UNIQUE(specialization, direction)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            language_code TEXT,
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _migration_booking_indexes(conn: sqlite3.Connection):
+    # Слоты на дату/диапазон дат и ORDER BY date, time_slot (в обе стороны)
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_date_slot_status
+        ON bookings (date, time_slot, status)
+    ''')
+    # /mybookings
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_user_status
+        ON bookings (user_id, status, date, time_slot)
+    ''')
+    # Очистка неоплаченных броней
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_status_created
+        ON bookings (status, created_at)
+    ''')
+
+    # Перед уникальным индексом освобождаем дубли: неоплаченная бронь уступает
+    # подтверждённой или более ранней неоплаченной на тот же слот
+    conn.execute('''
+        UPDATE bookings SET status = 'expired'
+        WHERE status = 'pending_payment' AND EXISTS (
+            SELECT 1 FROM bookings other
+            WHERE other.date = bookings.date
+              AND other.time_slot = bookings.time_slot
+              AND other.id != bookings.id
+              AND (other.status = 'confirmed'
+                   OR (other.status = 'pending_payment' AND other.id < bookings.id))
+        )
+    ''')
+    conflicts = conn.execute('''
+        SELECT date, time_slot, GROUP_CONCAT(id, ', ') FROM bookings
+        WHERE status IN ('confirmed', 'pending_payment')
+        GROUP BY date, time_slot HAVING COUNT(*) > 1
+        ORDER BY date
+    ''').fetchall()
+    only_after = ''
+    if conflicts:
+        # Двойные оплаченные брони автоматически не трогаем — их разбирает админ.
+        # Индекс тогда действует только на даты после последней такой пары: старт бота
+        # и админки не должен зависеть от того, разобрана ли история
+        only_after = f" AND date > '{conflicts[-1][0]}'"
+        logger.warning(
+            f"Есть двойные брони, уникальность слотов проверяется только после {conflicts[-1][0]}: "
+            + "; ".join(f"{d} {t} — брони #{ids}" for d, t, ids in conflicts)
+        )
+    conn.execute(f'''
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_bookings_active_slot
+        ON bookings (date, time_slot)
+        WHERE status IN ('confirmed', 'pending_payment'){only_after}
+    ''')
+    # Статистика для планировщика: без неё диапазон дат проигрывает индексу по статусу
+    conn.execute("ANALYZE")
+
+
+def _migration_data_versions(conn: sqlite3.Connection):
+    # Счётчики изменений таблиц: по ним процессы узнают, что кэш устарел
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('prices', 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_prices_version_{event.lower()}
+            AFTER {event} ON prices
+            BEGIN
+                UPDATE data_versions SET version = version + 1 WHERE name = 'prices';
+            END
+        ''')
+
+
+def _migration_scheduled_jobs(conn: sqlite3.Connection):
+    # Отложенные задачи (напоминания), переживающие перезапуск бота.
+    # run_at — местное время, как date/time_slot у броней
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            booking_id INTEGER NOT NULL,
+            run_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_status_run_at
+        ON scheduled_jobs (status, run_at)
+    ''')
+    # Напоминания для уже подтверждённых будущих занятий жили только в памяти
+    # прежней версии бота — переносим их сюда, за час до начала
+    conn.execute('''
+        INSERT INTO scheduled_jobs (kind, booking_id, run_at)
+        SELECT 'reminder', id, datetime(date || ' ' || time_slot, '-1 hour')
+        FROM bookings
+        WHERE status = 'confirmed'
+          AND datetime(date || ' ' || time_slot, '-1 hour') > datetime('now', 'localtime')
+    ''')
+
+
+def _migration_dashboard_filter_indexes(conn: sqlite3.Connection):
+    # Фильтры веб-админки; сортировка по (date, time_slot, id) берётся из индекса
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_status_date_slot
+        ON bookings (status, date, time_slot)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_spec_dir_date_slot
+        ON bookings (specialization, direction, date, time_slot)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_username
+        ON users (username)
+    ''')
+
+
+def _migration_export_jobs(conn: sqlite3.Connection):
+    # Версии броней и пользователей — ключ кэша готовых выгрузок
+    for table in ('bookings', 'users'):
+        conn.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)", (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+                END
+            ''')
+    # Фоновые выгрузки веб-админки (видны всем её процессам)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id TEXT PRIMARY KEY,
+            cache_key TEXT NOT NULL,
+            format TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued',
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            rows_total INTEGER,
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_export_jobs_cache_key_state
+        ON export_jobs (cache_key, state)
+    ''')
+
+
+# Цены по умолчанию: заводятся один раз при создании базы, дальше их меняет админ
+DEFAULT_PRICES = [
+    ('solo', 'percussion', 800.0),
+    ('solo', 'strings', 800.0),
+    ('solo', 'brass', 800.0),
+    ('solo', 'piano', 800.0),
+    ('solo', 'vocal', 800.0),
+    ('solo', 'mix', 800.0),
+
+    ('duet', 'percussion', 1200.0),
+    ('duet', 'strings', 1200.0),
+    ('duet', 'brass', 1200.0),
+    ('duet', 'piano', 1200.0),
+    ('duet', 'vocal', 1200.0),
+    ('duet', 'mix', 1200.0),
+
+    ('ensemble', 'percussion', 1500.0),
+    ('ensemble', 'strings', 1500.0),
+    ('ensemble', 'brass', 1500.0),
+    ('ensemble', 'piano', 1500.0),
+    ('ensemble', 'vocal', 1500.0),
+    ('ensemble', 'mix', 1500.0),
+]
+
+
+def _migration_seed_prices(conn: sqlite3.Connection):
+    conn.executemany('''
+        INSERT OR IGNORE INTO prices (specialization, direction, price)
+        VALUES (?, ?, ?)
+    ''', DEFAULT_PRICES)
+
+
+def _migration_rooms_and_occupancy(conn: sqlite3.Connection):
+    # Залы/преподаватели; часы работы каждого — в schedule.RESOURCE_HOURS
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rooms (
+            key TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            capacity INTEGER NOT NULL DEFAULT 1 CHECK (capacity > 0),
+            active INTEGER NOT NULL DEFAULT 1,
+            sort_order INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO rooms (key, name, capacity) VALUES ('hall', 'Зал', 1)")
+
+    # Все прежние брони были в единственном зале
+    conn.execute("ALTER TABLE bookings ADD COLUMN room TEXT")
+    conn.execute("UPDATE bookings SET room = 'hall' WHERE room IS NULL")
+
+    # Счётчик активных броней на (дата, слот, зал): свободно ли место — одно чтение по ключу
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS slot_occupancy (
+            date TEXT NOT NULL,
+            time_slot TEXT NOT NULL,
+            room TEXT NOT NULL,
+            booked INTEGER NOT NULL DEFAULT 0 CHECK (booked >= 0),
+            PRIMARY KEY (date, time_slot, room)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        INSERT INTO slot_occupancy (date, time_slot, room, booked)
+        SELECT date, time_slot, room, COUNT(*) FROM bookings
+        WHERE status IN ('confirmed', 'pending_payment')
+        GROUP BY date, time_slot, room
+    ''')
+
+    # Счётчики ведут триггеры в той же транзакции, что и запись брони, — кто бы её ни менял.
+    # Переполнение зала отменяет запись (sqlite3.IntegrityError), как раньше уникальный индекс.
+    active = "('confirmed', 'pending_payment')"
+    increment = '''
+        INSERT INTO slot_occupancy (date, time_slot, room, booked) VALUES (NEW.date, NEW.time_slot, NEW.room, 1)
+        ON CONFLICT (date, time_slot, room) DO UPDATE SET booked = booked + 1;
+        SELECT RAISE(ABORT, 'room is full') WHERE
+            (SELECT booked FROM slot_occupancy
+             WHERE date = NEW.date AND time_slot = NEW.time_slot AND room = NEW.room)
+            > COALESCE((SELECT capacity FROM rooms WHERE key = NEW.room), 0);
+    '''
+    decrement = '''
+        UPDATE slot_occupancy SET booked = booked - 1
+        WHERE date = OLD.date AND time_slot = OLD.time_slot AND room = OLD.room;
+    '''
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_occupancy_insert
+        AFTER INSERT ON bookings
+        WHEN NEW.status IN {active} AND NEW.room IS NOT NULL
+        BEGIN {increment} END
+    ''')
+    # Оплата (pending_payment → confirmed) место не меняет — счётчики не трогаем
+    same_place = f'''
+        OLD.status IN {active} AND NEW.status IN {active}
+        AND OLD.date = NEW.date AND OLD.time_slot = NEW.time_slot AND OLD.room IS NEW.room
+    '''
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_occupancy_release
+        AFTER UPDATE OF status, date, time_slot, room ON bookings
+        WHEN OLD.status IN {active} AND OLD.room IS NOT NULL AND NOT ({same_place})
+        BEGIN {decrement} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_occupancy_take
+        AFTER UPDATE OF status, date, time_slot, room ON bookings
+        WHEN NEW.status IN {active} AND NEW.room IS NOT NULL AND NOT ({same_place})
+        BEGIN {increment} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_occupancy_delete
+        AFTER DELETE ON bookings
+        WHEN OLD.status IN {active} AND OLD.room IS NOT NULL
+        BEGIN {decrement} END
+    ''')
+
+    # «Одна активная бронь на слот» больше не так: ограничение теперь — вместимость зала
+    conn.execute("DROP INDEX IF EXISTS ux_bookings_active_slot")
+
+
+def _migration_persistence(conn: sqlite3.Connection):
+    # Состояние диалогов и context.user_data бота (persistence.py): строка на ключ,
+    # значения — компактный JSON, чтобы переписывать только изменившиеся ключи
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (user_id, key)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state INTEGER NOT NULL,
+            updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+    ''')
+
+
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_booking_indexes,
+    _migration_data_versions,
+    _migration_scheduled_jobs,
+    _migration_dashboard_filter_indexes,
+    _migration_export_jobs,
+    _migration_seed_prices,
+    _migration_rooms_and_occupancy,
+    _migration_persistence,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+# --- Текущая версия данных таблицы (меняется триггерами при каждой записи) ---
+def get_data_version(conn: sqlite3.Connection, name: str) -> int:
+    row = conn.execute('SELECT version FROM data_versions WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+
+# --- Применить недостающие миграции, вернуть исходную версию схемы ---
+def migrate() -> int:
+    with connection() as conn:
+        start_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if start_version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Схема БД версии {start_version} новее кода (поддерживается до {SCHEMA_VERSION})"
+        )
+
+    for version, step in enumerate(MIGRATIONS, start=1):
+        if version <= start_version:
+            continue
+        with transaction(immediate=True) as conn:
+            # Другой процесс (бот или админка) мог успеть раньше
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                continue
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+        logger.info(f"Миграция БД {version} ({step.__name__}) применена")
+    return start_version
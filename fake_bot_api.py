@@ -0,0 +1,126 @@
+# fake_bot_api.py — заглушка Bot API для запуска бота без Telegram: отвечает на вызовы бота,
+# как Telegram, и печатает, что бот отправил пользователю. Те же ответы в памяти
+# использует нагрузочный тест (loadtest.py).
+#
+# Webhook-режим локально (три терминала):
+#   python fake_bot_api.py --port 8081
+#   TELEGRAM_API_URL=http://127.0.0.1:8081 TELEGRAM_BOT_TOKEN=123456:LOCAL ADMIN=1 \
+#       BOT_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8443/telegram WEBHOOK_SECRET=S python music_booking_bot.py
+#   python webhook_client.py --secret S command start
+import argparse
+import json
+import threading
+import time
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LocalBot", "username": "local_bot"}
+POLL_SECONDS = 1  # getUpdates: новых апдейтов у заглушки не бывает, отвечаем пустым списком не сразу
+
+
+# --- Ответы на методы Bot API; запоминает последнюю клавиатуру в каждом чате ---
+class FakeBotAPI:
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self.keyboards = {}
+        self.calls = {}
+        self._message_ids = 0
+        self._lock = threading.Lock()
+
+    def handle(self, api_method: str, params: dict):
+        with self._lock:
+            self.calls[api_method] = self.calls.get(api_method, 0) + 1
+            self._message_ids += 1
+            message_id = self._message_ids
+
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            chat_id = int(params.get('chat_id', 0))
+            markup = params.get('reply_markup')
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            if api_method != 'sendDocument':
+                self.keyboards[chat_id] = markup or {}
+            text = params.get('text') or params.get('caption') or ''
+            if self.verbose:
+                buttons = [button.get('text') for row in (markup or {}).get('inline_keyboard', []) for button in row]
+                print(f"→ {api_method} {chat_id}: {text}" + (f"\n  кнопки: {buttons}" if buttons else ''))
+            return {
+                "message_id": int(params.get('message_id', message_id)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": text,
+            }
+        if api_method == 'getUpdates':
+            return []
+        return True
+
+    # callback_data кнопок последней клавиатуры в чате, начинающиеся с prefix
+    def buttons(self, chat_id: int, prefix: str) -> list:
+        rows = self.keyboards.get(chat_id, {}).get('inline_keyboard', [])
+        return [
+            button['callback_data'] for row in rows for button in row
+            if button.get('callback_data', '').startswith(prefix)
+        ]
+
+
+# --- HTTP-сервер: /bot<token>/<метод>, параметры формой (так шлёт PTB) или JSON ---
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    api: FakeBotAPI = None
+
+    def do_POST(self):
+        api_method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        params = self._read_params()
+        if api_method == 'getUpdates':
+            time.sleep(min(float(params.get('timeout') or 0), POLL_SECONDS))
+        body = json.dumps({"ok": True, "result": self.api.handle(api_method, params)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def _read_params(self) -> dict:
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            # Файлы (выгрузка броней админу) не разбираем — нужны только простые поля
+            message = BytesParser(policy=policy.HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            return {
+                part.get_param('name', header='content-disposition'): part.get_payload(decode=True).decode()
+                for part in message.iter_parts() if part.get_filename() is None
+            }
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return dict(parse_qsl(body.decode()))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Bot API для локального запуска бота")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    FakeBotAPIHandler.api = FakeBotAPI(verbose=True)
+    server = ThreadingHTTPServer((args.host, args.port), FakeBotAPIHandler)
+    print(f"Заглушка Bot API на http://{args.host}:{args.port} (TELEGRAM_API_URL для бота)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
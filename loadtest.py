@@ -0,0 +1,229 @@
+# loadtest.py — нагрузочный тест бота без сети: приложение из build_application()
+# с поддельным транспортом к Bot API, тысячи пользователей проходят запись целиком
+# (специализация → направление → инструмент → дата → время → оплата).
+#
+#   python loadtest.py --users 500 --concurrency 100
+#   python loadtest.py --users 2000 --api-latency-ms 50 --fail-p95-ms 200
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота без сети")
+    parser.add_argument("--users", type=int, default=500, help="сколько пользователей проходят запись")
+    parser.add_argument("--concurrency", type=int, default=100, help="сколько пользователей одновременно")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="задержка ответа поддельного Bot API")
+    parser.add_argument("--db", default=None, help="файл базы (по умолчанию — новый во временной папке)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fail-p95-ms", type=float, default=None,
+                        help="выйти с кодом 1, если p95 какого-либо обработчика больше")
+    parser.add_argument("--verbose", action="store_true", help="не глушить print и логи бота")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# Бот читает настройки при импорте — задаём их до него
+_temp_dir = None if args.db else tempfile.mkdtemp(prefix="loadtest_")
+os.environ["BOOKING_DB_PATH"] = args.db or os.path.join(_temp_dir, "booking.db")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:LOADTEST")
+os.environ.setdefault("ADMIN", "1")
+os.environ.pop("TELEGRAM_API_URL", None)
+
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import db  # noqa: E402
+import music_booking_bot as bot  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from webhook_client import make_callback_update, make_message_update  # noqa: E402
+
+
+# --- Поддельный транспорт: ответы заглушки Bot API прямо в процессе, без HTTP ---
+class FakeRequest(BaseRequest):
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.api = FakeBotAPI()
+        self.calls = self.api.calls
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        result = self.api.handle(url.rsplit('/', 1)[-1], params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def buttons(self, chat_id: int, prefix: str) -> list:
+        return self.api.buttons(chat_id, prefix)
+
+
+# --- Сценарий одного пользователя ---
+class UserFlow:
+    def __init__(self, app, transport: FakeRequest, user_id: int, rng: random.Random, timings: dict,
+                 outcomes: dict):
+        self.app = app
+        self.transport = transport
+        self.user_id = user_id
+        self.rng = rng
+        self.timings = timings
+        self.outcomes = outcomes
+
+    async def step(self, handler: str, payload: dict):
+        update = Update.de_json(payload, self.app.bot)
+        started = time.perf_counter()
+        await self.app.process_update(update)
+        self.timings.setdefault(handler, []).append(time.perf_counter() - started)
+
+    async def callback(self, handler: str, data: str):
+        await self.step(handler, make_callback_update(self.user_id, data))
+
+    def outcome(self, name: str):
+        self.outcomes[name] = self.outcomes.get(name, 0) + 1
+
+    async def run(self):
+        await self.step('start', make_message_update(self.user_id, '/start'))
+        await self.callback('select_specialization', 'select_spec')
+        await self.callback('select_direction', self.rng.choice(self.transport.buttons(self.user_id, 'spec_')))
+
+        direction = self.rng.choice(self.transport.buttons(self.user_id, 'dir_'))
+        await self.callback('select_instrument', direction)
+        instruments = self.transport.buttons(self.user_id, 'inst_')
+        if instruments:
+            await self.callback('handle_instrument_choice', self.rng.choice(instruments))
+
+        dates = self.transport.buttons(self.user_id, 'date_')
+        if not dates:
+            self.outcome('no_free_dates')
+            return
+        await self.callback('handle_date_choice', self.rng.choice(dates))
+
+        # Слот могут занять, пока пользователь выбирает, — тогда бот покажет свежее время
+        for _ in range(3):
+            slots = self.transport.buttons(self.user_id, 'time_')
+            if not slots:
+                self.outcome('no_free_slots')
+                return
+            await self.callback('handle_time_choice', self.rng.choice(slots))
+            if self.transport.buttons(self.user_id, 'confirm_payment'):
+                break
+            self.outcome('slot_taken')
+        else:
+            self.outcome('gave_up')
+            return
+
+        await self.callback('confirm_payment', 'confirm_payment')
+        self.outcome('confirmed')
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def print_report(timings: dict, outcomes: dict, errors: list, elapsed: float, waits: dict, transport: FakeRequest):
+    updates = sum(len(values) for values in timings.values())
+    print(f"\nПользователей: {args.users}, одновременно: {args.concurrency}, "
+          f"задержка API: {args.api_latency_ms:.0f} мс")
+    print(f"Апдейтов: {updates} за {elapsed:.2f} с — {updates / elapsed:.0f} апдейтов/с, "
+          f"{outcomes.get('confirmed', 0) / elapsed:.1f} броней/с")
+    print("Исходы: " + ", ".join(f"{name} {count}" for name, count in sorted(outcomes.items()))
+          + f", ошибок {len(errors)}")
+    print("Вызовы API: " + ", ".join(f"{name} {count}" for name, count in sorted(transport.calls.items())))
+
+    print(f"\n{'Обработчик':<26}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  (мс)")
+    for handler, values in timings.items():
+        print(f"{handler:<26}{len(values):>7}"
+              + "".join(f"{percentile(values, q) * 1000:>9.1f}" for q in (0.5, 0.95, 0.99))
+              + f"{max(values) * 1000:>9.1f}")
+
+    print("\nОжидание БД:")
+    for name, stats in waits.items():
+        average = stats['total'] / stats['count'] * 1000 if stats['count'] else 0
+        print(f"  {name:<16} {stats['count']:>7} раз, всего {stats['total'] * 1000:.0f} мс, "
+              f"в среднем {average:.2f} мс, максимум {stats['max'] * 1000:.1f} мс")
+    for error in errors[:5]:
+        print(f"Ошибка: {error!r}")
+
+
+async def run_load_test() -> int:
+    transport = FakeRequest(args.api_latency_ms / 1000)
+    bot.init_db()
+    app = bot.build_application(request=transport)
+
+    errors = []
+
+    async def collect_error(update, context):
+        errors.append(context.error)
+
+    app.add_error_handler(collect_error)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    for stats in db.wait_stats.values():
+        stats.reset()
+
+    rng = random.Random(args.seed)
+    timings, outcomes = {}, {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(user_id: int):
+        async with semaphore:
+            flow = UserFlow(app, transport, user_id, random.Random(rng.random()), timings, outcomes)
+            try:
+                await flow.run()
+            except Exception as e:
+                errors.append(e)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(100000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    waits = {name: stats.snapshot() for name, stats in db.wait_stats.items()}
+
+    # Порядок как в run_polling: shutdown() сохраняет persistence через db.run,
+    # а post_shutdown (on_shutdown) уже закрывает потоки и пул БД
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+    print_report(timings, outcomes, errors, elapsed, waits, transport)
+    if errors:
+        return 1
+    if args.fail_p95_ms is not None:
+        slow = [handler for handler, values in timings.items()
+                if percentile(values, 0.95) * 1000 > args.fail_p95_ms]
+        if slow:
+            print(f"\n❌ p95 больше {args.fail_p95_ms:.0f} мс: {', '.join(slow)}")
+            return 1
+    return 0
+
+
+def main():
+    try:
+        if args.verbose:
+            return asyncio.run(run_load_test())
+        # INFO-логи бота на каждом апдейте искажают замер и засыпают вывод
+        logging.getLogger().setLevel(logging.WARNING)
+        return asyncio.run(run_load_test())
+    finally:
+        if _temp_dir:
+            shutil.rmtree(_temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
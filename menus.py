@@ -0,0 +1,91 @@
+# menus.py — статичные клавиатуры бота в одном месте.
+# Разметка собирается один раз при старте (и заново, когда меняются цены),
+# обработчики берут готовый InlineKeyboardMarkup по ключу.
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# --- Каталог: ключ, эмодзи, название в меню, короткое название ---
+SPECIALIZATIONS = [
+    ('solo', '🎼', 'Соло', 'Соло'),
+    ('duet', '💞', 'Дуэт', 'Дуэт'),
+    ('ensemble', '🎻', 'Ансамбль (3+)', 'Ансамбль'),
+]
+DIRECTIONS = [
+    ('percussion', '🥁', 'Ударные'),
+    ('strings', '🎻', 'Струнные'),
+    ('brass', '🎷', 'Духовые'),
+    ('piano', '🎹', 'Фортепиано'),
+    ('vocal', '🎤', 'Вокал'),
+    ('mix', '🎶', 'Микс'),
+]
+# Направления, где после направления выбирают конкретный инструмент
+INSTRUMENTS = {
+    'percussion': [
+        ('drums', '🥁 Барабаны'),
+        ('percc', '🥁 Перкуссия'),
+        ('timpani', '🥁 Тимпаны'),
+        ('electronic', '🥁 Электронные ударные'),
+        ('all', '🥁 Все вышеперечисленное'),
+    ],
+}
+
+
+# --- Описание меню: ключ → строки кнопок (текст, callback_data) ---
+def _menu_rows(prices: dict) -> dict:
+    menus = {
+        'start': [[("🎹 Выбрать специализацию", 'select_spec')]],
+        'payment': [
+            [("✅ Я оплатил", 'confirm_payment')],
+            [("❌ Отменить", 'cancel_booking')],
+        ],
+        'admin': [
+            [("📊 Просмотр всех броней", 'admin_view_bookings')],
+            [("➕ Забронировать без оплаты", 'admin_create_booking')],
+            [("💰 Изменить цену", 'admin_change_price')],
+        ],
+        'admin_back': [[("← Назад в админку", 'admin_back')]],
+    }
+
+    # Пользователь и админ выбирают по одному каталогу, отличается только префикс callback_data
+    for prefix in ('', 'admin_'):
+        menus[f'{prefix}specializations'] = [
+            [(f"{emoji} {title}", f'{prefix}spec_{key}')] for key, emoji, title, _ in SPECIALIZATIONS
+        ]
+        menus[f'{prefix}directions'] = [
+            [(f"{emoji} {title}", f'{prefix}dir_{key}')] for key, emoji, title in DIRECTIONS
+        ]
+        for direction, instruments in INSTRUMENTS.items():
+            menus[f'{prefix}instruments_{direction}'] = [
+                [(title, f'{prefix}inst_{key}')] for key, title in instruments
+            ]
+
+    price_rows = []
+    for spec, spec_emoji, _, spec_short in SPECIALIZATIONS:
+        for direction, _, direction_title in DIRECTIONS:
+            price = prices.get((spec, direction))
+            price_text = f" · {price:.0f} ₽" if price is not None else ""
+            price_rows.append([(
+                f"{spec_emoji} {spec_short} — {direction_title}{price_text}",
+                f'admin_price_{spec}_{direction}',
+            )])
+    price_rows.append([("← Назад", 'admin_back')])
+    menus['admin_prices'] = price_rows
+    return menus
+
+
+# --- Реестр готовых клавиатур ---
+_menus: dict = {}
+
+
+def rebuild(prices: dict):
+    global _menus
+    # Новый словарь подменяется целиком — читатели в других потоках видят либо старый, либо новый
+    _menus = {
+        key: InlineKeyboardMarkup([
+            [InlineKeyboardButton(text, callback_data=data) for text, data in row] for row in rows
+        ])
+        for key, rows in _menu_rows(prices).items()
+    }
+
+
+def get(key: str) -> InlineKeyboardMarkup:
+    return _menus[key]
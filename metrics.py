@@ -0,0 +1,141 @@
+# metrics.py — счётчики и гистограммы в текстовом формате Prometheus, без внешних зависимостей.
+# Бот отдаёт их отдельным маленьким HTTP-сервером (METRICS_PORT), веб-админка — на /metrics.
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_metrics = []
+_collectors = []  # функции, которые при выводе отдают готовые строки (например, ожидания в db.py)
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._values = {}  # метки → [счётчики по корзинам..., сумма, количество]
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, data in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, data):
+                    lines.append(f"{self.name}_bucket{_label_text(labels + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_label_text(labels + (('le', '+Inf'),))} {data[-1]}")
+                lines.append(f"{self.name}_sum{_label_text(labels)} {data[-2]}")
+                lines.append(f"{self.name}_count{_label_text(labels)} {data[-1]}")
+        return lines
+
+
+def register_collector(collector):
+    _collectors.append(collector)
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+# --- Общие метрики бота и админки ---
+handler_seconds = Histogram('bot_handler_seconds', 'Время обработки апдейта, по обработчикам')
+handler_errors = Counter('bot_handler_errors_total', 'Исключения в обработчиках')
+sql_seconds = Histogram('db_statement_seconds', 'Время выполнения SQL, по месту вызова и типу запроса')
+bookings = Counter('bookings_total', 'Изменения броней: created, confirmed, cancelled, expired, slot_taken')
+group_commit_ops = Histogram('db_group_commit_ops', 'Операций в одной транзакции группового коммита',
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+
+# --- Обёртка для async-обработчиков Telegram: время и ошибки по имени функции ---
+def timed_handler(callback):
+    name = getattr(callback, '__name__', repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, handler=name)
+
+    wrapper.timed = True
+    return wrapper
+
+
+# --- HTTP-сервер для Prometheus в отдельном потоке ---
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Метрики: http://{host}:{port}/metrics")
+    return server
@@ -1,26 +1,70 @@
+import time
+
+_import_started = time.perf_counter()  # для отчёта о времени запуска
+
+import asyncio
+import csv
+import io
 import logging
 import sqlite3
-from datetime import datetime, timedelta
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from typing import Dict, Optional
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
 import os
+
+import db
+import menus
+import metrics
+import persistence
+import schedule
+import sharding
+from outbox import GLOBAL_RATE, MessageDispatcher
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN"))
-DB_PATH = os.path.join(os.path.dirname(__file__), "booking.db")
-TIME_SLOT_DURATION = 30  # минут
-WORK_START_HOUR = 10
-WORK_END_HOUR = 20
 PAYMENT_TIMEOUT_MINUTES = 15  # через сколько минут отменить бронь, если не оплачено
+PRICE_CACHE_CHECK_SECONDS = 10  # как часто сверять кэш цен с базой
+REMINDER_LEAD_HOURS = 1  # за сколько часов до занятия напоминать
+REMINDER_WINDOW_HOURS = 24  # напоминания на сколько часов вперёд держать в памяти
+REMINDER_REFILL_MINUTES = 60  # как часто подгружать следующее окно напоминаний
+USER_CACHE_SIZE = 50000  # сколько профилей пользователей помнить, чтобы не писать их в базу на каждый /start
+USER_FLUSH_SECONDS = 3  # как часто записывать новых и изменившихся пользователей
+AVAILABILITY_TTL_SECONDS = 30  # сколько держать занятость даты в памяти (страховка от записей веб-админки)
+
+# --- Режим работы: polling (по умолчанию) или webhook ---
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой Bot API сервер или заглушка fake_bot_api.py
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))  # сколько апдейтов обрабатывать одновременно
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com/telegram
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Telegram присылает его в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — сервер метрик не запускать
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))  # больше 1 — апдейты обрабатывают процессы-воркеры (sharding.py)
+
+# Номер этого процесса среди воркеров и их число; без воркеров — 0 из 1
+SHARD_INDEX = 0
+SHARD_COUNT = 1
 
 # --- Состояния для ConversationHandler ---
 (
@@ -45,189 +89,592 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# --- База данных ---
-import os
-DB_PATH = os.path.join(os.path.dirname(__file__), "booking.db")
+# --- Воркер: свои пользователи — те, у кого user_id % SHARD_COUNT == SHARD_INDEX ---
+def set_shard(index: int, count: int):
+    global SHARD_INDEX, SHARD_COUNT, METRICS_PORT
+    SHARD_INDEX, SHARD_COUNT = index, count
+    if METRICS_PORT:
+        METRICS_PORT += 1 + index  # METRICS_PORT остаётся у входного процесса
 
+
+# --- База данных ---
 def init_db():
-    print(f"📁 Используется база данных по пути: {os.path.abspath(DB_PATH)}")  # 👈 ВЫВОД ПУТИ!
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS bookings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            specialization TEXT,
-            direction TEXT,
-            instrument TEXT,
-            date TEXT,
-            time_slot TEXT,
-            status TEXT DEFAULT 'pending_payment',
-            payment_id TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            paid_at DATETIME,
-            price REAL NOT NULL DEFAULT 800.0
-        )
-    ''')
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS prices (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            specialization TEXT UNIQUE,
-            direction TEXT UNIQUE,
-            price REAL NOT NULL DEFAULT 800.0
-        )
-    ''')
-
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            language_code TEXT,
-            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    default_prices = [
-        ('solo', 'percussion', 800.0),
-        ('solo', 'strings', 800.0),
-        ('solo', 'brass', 800.0),
-        ('solo', 'piano', 800.0),
-        ('solo', 'vocal', 800.0),
-        ('solo', 'mix', 800.0),
-
-        ('duet', 'percussion', 1200.0),
-        ('duet', 'strings', 1200.0),
-        ('duet', 'brass', 1200.0),
-        ('duet', 'piano', 1200.0),
-        ('duet', 'vocal', 1200.0),
-        ('duet', 'mix', 1200.0),
-
-        ('ensemble', 'percussion', 1500.0),
-        ('ensemble', 'strings', 1500.0),
-        ('ensemble', 'brass', 1500.0),
-        ('ensemble', 'piano', 1500.0),
-        ('ensemble', 'vocal', 1500.0),
-        ('ensemble', 'mix', 1500.0),
-    ]
+    print(f"📁 Используется база данных по пути: {os.path.abspath(db.DB_PATH)}")  # 👈 ВЫВОД ПУТИ!
+    # Схема и цены по умолчанию заводятся миграциями; если база актуальна, здесь одна проверка версии
+    db.migrate()
+    load_rooms()
+    _refresh_price_cache(force=True)
+    print("✅ База данных инициализирована.")
 
-    for spec, dir, price in default_prices:
-        c.execute('''
-            INSERT OR IGNORE INTO prices (specialization, direction, price)
-            VALUES (?, ?, ?)
-        ''', (spec, dir, price))
 
-    conn.commit()
-    conn.close()
-    print("✅ База данных инициализирована.")
+# --- Кэш цен (таблица prices целиком в памяти) ---
+_price_cache: Dict[tuple, float] = {}
+_price_cache_version = None
+_price_cache_checked_at = 0.0
+_price_cache_lock = threading.Lock()
+
+
+def _refresh_price_cache(force: bool = False):
+    global _price_cache, _price_cache_version, _price_cache_checked_at
+    with _price_cache_lock:
+        with db.connection() as conn:
+            version = db.get_data_version(conn, 'prices')
+            if force or version != _price_cache_version:
+                rows = conn.execute('SELECT specialization, direction, price FROM prices').fetchall()
+                _price_cache = {(row['specialization'], row['direction']): row['price'] for row in rows}
+                _price_cache_version = version
+                menus.rebuild(_price_cache)
+        _price_cache_checked_at = time.monotonic()
+
+
+# Версию в БД проверяем не чаще раза в PRICE_CACHE_CHECK_SECONDS — так
+# подхватываются цены, изменённые другим процессом (веб-админкой)
+def check_price_cache():
+    if time.monotonic() - _price_cache_checked_at > PRICE_CACHE_CHECK_SECONDS:
+        _refresh_price_cache()
 
 
 # --- Получить цену по специализации и направлению ---
 def get_price(spec: str, dir: str) -> float:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT price FROM prices WHERE specialization = ? AND direction = ?', (spec, dir))
-    row = c.fetchone()
-    conn.close()
-    return row['price'] if row else 800.0
+    check_price_cache()
+    return _price_cache.get((spec, dir), 800.0)
+
+
+# --- Залы из таблицы rooms (часы работы — в schedule.RESOURCE_HOURS) ---
+def load_rooms():
+    with db.connection() as conn:
+        rooms = conn.execute('''
+            SELECT key, name, capacity FROM rooms WHERE active = 1 ORDER BY sort_order, key
+        ''').fetchall()
+    schedule.set_resources(rooms)
+    logger.info(f"Залы: {', '.join(f'{room[1]} ×{room[2]}' for room in rooms)}")
+
 
+# --- Счётчики занятости слота по залам: {зал: занято} ---
+def _slot_booked(conn, date_str: str, time_slot: str) -> Dict[str, int]:
+    rows = conn.execute('''
+        SELECT room, booked FROM slot_occupancy WHERE date = ? AND time_slot = ?
+    ''', (date_str, time_slot)).fetchall()
+    return {room: booked for room, booked in rows}
 
-# --- Проверка доступности слота ---
+
+# Первый открытый зал, где есть место, или None
+def _pick_room(rooms: list, booked: Dict[str, int]) -> Optional[str]:
+    for room, capacity in rooms:
+        if booked.get(room, 0) < capacity:
+            return room
+    return None
+
+
+# --- Проверка доступности слота (с учётом расписания и вместимости залов) ---
 def is_slot_available(date_str: str, time_slot: str) -> bool:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        SELECT COUNT(*) FROM bookings 
-        WHERE date = ? AND time_slot = ? AND status IN ('confirmed', 'pending_payment')
-    ''', (date_str, time_slot))
-    count = c.fetchone()[0]
-    conn.close()
-    return count == 0
+    rooms = schedule.day_plan(date_str).rooms_for_slot(time_slot)
+    if not rooms:
+        return False
+    with db.connection() as conn:
+        booked = _slot_booked(conn, date_str, time_slot)
+    return _pick_room(rooms, booked) is not None
+
+
+# --- Счётчики занятости за диапазон дат (один запрос): {дата: {зал: {слот: занято}}} ---
+def get_occupied_slots(start_date: str, end_date: str) -> Dict[str, Dict[str, Dict[str, int]]]:
+    with db.connection() as conn:
+        rows = conn.execute('''
+            SELECT date, time_slot, room, booked FROM slot_occupancy
+            WHERE date BETWEEN ? AND ? AND booked > 0
+        ''', (start_date, end_date)).fetchall()
+    occupied = {}
+    for date_str, time_slot, room, booked in rows:
+        occupied.setdefault(date_str, {}).setdefault(room, {})[time_slot] = booked
+    return occupied
+
+
+# --- Кэш занятости по датам ---
+# Свои изменения (save_booking, смена статуса, истечение) сбрасывают только затронутую дату,
+# изменения из веб-админки подхватываются по истечении AVAILABILITY_TTL_SECONDS.
+_availability_cache: Dict[str, tuple] = {}  # дата → ({зал: {слот: занято}}, когда загружено)
+_availability_generation: Dict[str, int] = {}  # дата → сколько раз её сбрасывали
+_availability_lock = threading.Lock()
+
+
+def invalidate_availability(*dates: str):
+    with _availability_lock:
+        for date_str in dates:
+            _availability_cache.pop(date_str, None)
+            _availability_generation[date_str] = _availability_generation.get(date_str, 0) + 1
+
+
+def _get_occupied_cached(dates: list) -> Dict[str, Dict[str, Dict[str, int]]]:
+    now = time.monotonic()
+    result, missing = {}, []
+    with _availability_lock:
+        for date_str in dates:
+            cached = _availability_cache.get(date_str)
+            if cached and now - cached[1] < AVAILABILITY_TTL_SECONDS:
+                result[date_str] = cached[0]
+            else:
+                missing.append(date_str)
+        generations = {date_str: _availability_generation.get(date_str, 0) for date_str in missing}
+    if not missing:
+        return result
+
+    occupied = get_occupied_slots(min(missing), max(missing))
+    with _availability_lock:
+        if len(_availability_cache) > 1000:
+            _availability_cache.clear()
+        for date_str in missing:
+            counts = occupied.get(date_str, {})
+            result[date_str] = counts
+            # Дату сбросили, пока шёл запрос — прочитанное могло устареть, в кэш не кладём
+            if _availability_generation.get(date_str, 0) == generations[date_str]:
+                _availability_cache[date_str] = (counts, now)
+    return result
+
+
+# --- Свободные слоты для нескольких дат: открытые по расписанию минус заполненные ---
+def get_available_slots_range(dates: list) -> Dict[str, list]:
+    if not dates:
+        return {}
+    # Закрытые дни в базу не запрашиваем
+    open_dates = [date_str for date_str in dates if schedule.day_plan(date_str).open_mask]
+    occupied = _get_occupied_cached(open_dates) if open_dates else {}
+    result = {}
+    for date_str in dates:
+        plan = schedule.day_plan(date_str)
+        result[date_str] = plan.labels(plan.free_mask(occupied.get(date_str, {})))
+    return result
 
 
 # --- Получить все доступные слоты на дату ---
 def get_available_slots(date_str: str) -> list:
-    slots = []
-    for hour in range(WORK_START_HOUR, WORK_END_HOUR):
-        for minute in [0, 30]:
-            slot_time = f"{hour:02d}:{minute:02d}"
-            if is_slot_available(date_str, slot_time):
-                slots.append(slot_time)
-    return slots
-
-
-# --- Сохранить бронь ---
-def save_booking(user_id: int, spec: str, dir: str, inst: str, date: str, time_slot: str, status='pending_payment'):
-    price = get_price(spec, dir)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO bookings (user_id, specialization, direction, instrument, date, time_slot, status, price)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, spec, dir, inst, date, time_slot, status, price))
-    booking_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    return get_available_slots_range([date_str])[date_str]
+
+
+# --- Сохранить бронь (выбор зала и вставка — одна транзакция) ---
+# Возвращает id брони или None, если свободных мест в слоте нет
+# Операции для db.GroupCommitWriter: пишут через общую транзакцию пачки и не коммитят сами.
+# BEGIN IMMEDIATE пачки держит блокировку записи: между проверкой и вставкой никто
+# (ни другой поток, ни веб-админка) не займёт место. Счётчик slot_occupancy
+# увеличит триггер в этой же транзакции.
+def _insert_booking(conn, user_id: int, spec: str, dir: str, inst: str, date: str, time_slot: str,
+                    rooms: list, status: str, price: float) -> Optional[int]:
+    room = _pick_room(rooms, _slot_booked(conn, date, time_slot))
+    if room is None:
+        return None
+    try:
+        c = conn.execute('''
+            INSERT INTO bookings (user_id, specialization, direction, instrument, date, time_slot, room, status, price)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, spec, dir, inst, date, time_slot, room, status, price))
+    except sqlite3.IntegrityError:
+        # Триггер счётчика: зал уже заполнен
+        return None
+    return c.lastrowid
+
+
+async def save_booking(writer: db.GroupCommitWriter, user_id: int, spec: str, dir: str, inst: str, date: str,
+                       time_slot: str, status='pending_payment') -> Optional[int]:
+    rooms = schedule.day_plan(date).rooms_for_slot(time_slot)
+    if not rooms:  # слота нет в расписании (выходной, нерабочее время)
+        return None
+    # Цену берём до очереди: сверка кэша цен идёт в базу своим соединением, а пачка держит блокировку записи
+    price = await db.run(get_price, spec, dir)
+    booking_id = await writer.submit(_insert_booking, user_id, spec, dir, inst, date, time_slot, rooms, status,
+                                     price)
+    metrics.bookings.inc(event='created' if booking_id else 'slot_taken')
+    # И при успехе, и при занятом слоте кэш этой даты больше не верен
+    invalidate_availability(date)
     return booking_id
 
 
 # --- Обновить статус брони ---
-def update_booking_status(booking_id: int, status: str, payment_id: str = None):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    if status == "confirmed":
-        c.execute('''
-            UPDATE bookings SET status = ?, paid_at = CURRENT_TIMESTAMP WHERE id = ?
-        ''', (status, booking_id))
-    else:
-        c.execute('''
-            UPDATE bookings SET status = ? WHERE id = ?
-        ''', (status, booking_id))
-    conn.commit()
-    conn.close()
+# Подтвердить можно только ожидающую оплаты бронь; возвращает, изменилась ли запись.
+# Счётчики slot_occupancy поправят триггеры в этой же транзакции.
+def _set_booking_status(conn, booking_id: int, status: str) -> Optional[str]:
+    try:
+        if status == "confirmed":
+            c = conn.execute('''
+                UPDATE bookings SET status = ?, paid_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'pending_payment'
+            ''', (status, booking_id))
+        else:
+            c = conn.execute('''
+                UPDATE bookings SET status = ? WHERE id = ?
+            ''', (status, booking_id))
+    except sqlite3.IntegrityError:
+        # Отменённую бронь вернули в активные, а зал уже заполнен
+        return None
+    if not c.rowcount:
+        return None
+    return conn.execute('SELECT date FROM bookings WHERE id = ?', (booking_id,)).fetchone()['date']
+
+
+async def update_booking_status(writer: db.GroupCommitWriter, booking_id: int, status: str,
+                                payment_id: str = None) -> bool:
+    date = await writer.submit(_set_booking_status, booking_id, status)
+    if date:
+        invalidate_availability(date)
+        metrics.bookings.inc(event=status)
+    return date is not None
 
 
 # --- Получить бронь по ID ---
 def get_booking_by_id(booking_id: int) -> Optional[dict]:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM bookings WHERE id = ?', (booking_id,))
-    row = c.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        row = conn.execute('SELECT * FROM bookings WHERE id = ?', (booking_id,)).fetchone()
     return dict(row) if row else None
 
 
-# --- Удалить просроченные брони ---
+# --- Удалить просроченные брони (при старте, до групповой записи, — своей транзакцией) ---
 def cleanup_expired_bookings():
-    timeout = datetime.now() - timedelta(minutes=PAYMENT_TIMEOUT_MINUTES)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        UPDATE bookings SET status = 'expired' 
-        WHERE status = 'pending_payment' AND created_at < ?
-    ''', (timeout.strftime('%Y-%m-%d %H:%M:%S'),))
-    conn.commit()
-    conn.close()
+    # created_at заполняет CURRENT_TIMESTAMP, то есть время в UTC
+    timeout = (datetime.now(timezone.utc) - timedelta(minutes=PAYMENT_TIMEOUT_MINUTES)).strftime('%Y-%m-%d %H:%M:%S')
+    with db.transaction(immediate=True) as conn:
+        dates = [row['date'] for row in conn.execute('''
+            SELECT DISTINCT date FROM bookings
+            WHERE status = 'pending_payment' AND created_at < ?
+        ''', (timeout,))]
+        c = conn.execute('''
+            UPDATE bookings SET status = 'expired' 
+            WHERE status = 'pending_payment' AND created_at < ?
+        ''', (timeout,))
+    invalidate_availability(*dates)
+    if c.rowcount:
+        metrics.bookings.inc(c.rowcount, event='expired')
     logger.info("Просроченные брони очищены.")
 
 
+# --- Снять одну неоплаченную бронь (если её ещё не оплатили и не отменили) ---
+def _expire_booking(conn, booking_id: int) -> Optional[str]:
+    c = conn.execute('''
+        UPDATE bookings SET status = 'expired'
+        WHERE id = ? AND status = 'pending_payment'
+    ''', (booking_id,))
+    if not c.rowcount:
+        return None
+    return conn.execute('SELECT date FROM bookings WHERE id = ?', (booking_id,)).fetchone()['date']
+
+
+async def expire_booking(writer: db.GroupCommitWriter, booking_id: int) -> bool:
+    date = await writer.submit(_expire_booking, booking_id)
+    if date:
+        invalidate_availability(date)
+        metrics.bookings.inc(event='expired')
+    return date is not None
+
+
+# --- Неоплаченные брони и время их создания ---
+def get_pending_bookings() -> list:
+    with db.connection() as conn:
+        return conn.execute('''
+            SELECT id, created_at FROM bookings
+            WHERE status = 'pending_payment' AND user_id % ? = ?
+        ''', (SHARD_COUNT, SHARD_INDEX)).fetchall()
+
+
+# --- Таймер оплаты: бронь освобождается ровно через PAYMENT_TIMEOUT_MINUTES ---
+def _expiry_job_name(booking_id: int) -> str:
+    return f"expire_booking_{booking_id}"
+
+
+async def expire_booking_job(context: ContextTypes.DEFAULT_TYPE):
+    booking_id = context.job.data['booking_id']
+    if await expire_booking(context.bot_data['writer'], booking_id):
+        logger.info(f"Бронь #{booking_id} не оплачена вовремя, слот освобождён")
+
+
+def schedule_booking_expiry(job_queue, booking_id: int, delay: float = PAYMENT_TIMEOUT_MINUTES * 60):
+    job_queue.run_once(
+        expire_booking_job,
+        when=max(delay, 0),
+        data={'booking_id': booking_id},
+        name=_expiry_job_name(booking_id),
+    )
+
+
+def cancel_booking_expiry(job_queue, booking_id: int):
+    for job in job_queue.get_jobs_by_name(_expiry_job_name(booking_id)):
+        job.schedule_removal()
+
+
+# --- При старте: снять просроченные брони и завести таймеры для остальных ---
+def restore_booking_expiries(job_queue):
+    cleanup_expired_bookings()
+    now = datetime.now(timezone.utc)
+    pending = get_pending_bookings()
+    for row in pending:
+        created_at = datetime.strptime(row['created_at'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        expires_at = created_at + timedelta(minutes=PAYMENT_TIMEOUT_MINUTES)
+        schedule_booking_expiry(job_queue, row['id'], (expires_at - now).total_seconds())
+    logger.info(f"Таймеры оплаты восстановлены: {len(pending)}")
+
+
+# --- Пользователи: кэш известных профилей и отложенная запись ---
+# /start от знакомого пользователя с тем же профилем в базу не ходит; новые и изменившиеся
+# профили копятся и пишутся одной транзакцией раз в USER_FLUSH_SECONDS (и при остановке).
+_known_users: OrderedDict = OrderedDict()  # user_id → (username, first_name, language_code), LRU
+_pending_users: Dict[int, tuple] = {}
+_pending_users_lock = threading.Lock()
+
+
+def remember_user(user_id: int, username: str, first_name: str, language_code: str):
+    profile = (username, first_name, language_code)
+    if _known_users.get(user_id) == profile:
+        _known_users.move_to_end(user_id)
+        return
+    _known_users[user_id] = profile
+    _known_users.move_to_end(user_id)
+    if len(_known_users) > USER_CACHE_SIZE:
+        _known_users.popitem(last=False)
+    with _pending_users_lock:
+        _pending_users[user_id] = profile
+
+
+def flush_users() -> int:
+    global _pending_users
+    with _pending_users_lock:
+        pending, _pending_users = _pending_users, {}
+    if not pending:
+        return 0
+    try:
+        with db.transaction() as conn:
+            # Профиль не изменился (пользователь выпал из кэша или бот перезапущен) — строку не трогаем
+            conn.executemany('''
+                INSERT INTO users (user_id, username, first_name, language_code)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    language_code = excluded.language_code
+                WHERE username IS NOT excluded.username
+                   OR first_name IS NOT excluded.first_name
+                   OR language_code IS NOT excluded.language_code
+            ''', [(user_id, *profile) for user_id, profile in pending.items()])
+    except Exception:
+        with _pending_users_lock:
+            for user_id, profile in pending.items():
+                _pending_users.setdefault(user_id, profile)  # более свежий профиль уже в очереди
+        raise
+    return len(pending)
+
+
+async def flush_users_job(context: ContextTypes.DEFAULT_TYPE):
+    saved = await db.run(flush_users)
+    if saved:
+        logger.debug(f"Пользователей записано: {saved}")
+
+
+# --- Активные брони пользователя ---
+def get_user_bookings(user_id: int) -> list:
+    with db.connection() as conn:
+        return conn.execute('''
+            SELECT date, time_slot, direction, instrument, status
+            FROM bookings
+            WHERE user_id = ? AND status IN ('confirmed', 'pending_payment')
+            ORDER BY date, time_slot
+        ''', (user_id,)).fetchall()
+
+
+# --- Брони для админа: страницы по ключу (date, time_slot, id), новые сверху ---
+# OFFSET и полная выборка медленнее с ростом таблицы, а ключ страницы берётся из индекса
+ADMIN_PAGE_SIZE = 10
+ADMIN_EXPORT_CHUNK = 500
+ADMIN_BOOKING_FILTERS = [
+    ('all', 'Все'),
+    ('today', 'Сегодня'),
+    ('week', 'Эта неделя'),
+    ('pending', 'Ждут оплаты'),
+]
+ADMIN_EXPORT_COLUMNS = ['ID', 'Имя пользователя', 'Имя', 'Специализация', 'Направление',
+                        'Инструмент', 'Дата', 'Время', 'Статус', 'Цена']
+
+
+def _admin_bookings_where(filter_key: str) -> tuple:
+    today = datetime.now().date()
+    if filter_key == 'today':
+        return ['b.date = ?'], [today.isoformat()]
+    if filter_key == 'week':
+        monday = today - timedelta(days=today.weekday())
+        return ['b.date BETWEEN ? AND ?'], [monday.isoformat(), (monday + timedelta(days=6)).isoformat()]
+    if filter_key == 'pending':
+        return ["b.status = 'pending_payment'"], []
+    return [], []
+
+
+# backward=True — строки «новее» курсора (кнопка «назад»), в порядке от курсора
+def _select_admin_bookings(conn, filter_key: str, cursor: Optional[tuple], backward: bool, limit: int) -> list:
+    where, params = _admin_bookings_where(filter_key)
+    if cursor:
+        where.append(f"(b.date, b.time_slot, b.id) {'>' if backward else '<'} (?, ?, ?)")
+        params.extend(cursor)
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+    order = 'ASC' if backward else 'DESC'
+    return conn.execute(f'''
+        SELECT
+            b.id,
+            b.user_id,
+            u.username,
+            u.first_name,
+            b.specialization,
+            b.direction,
+            b.instrument,
+            b.date,
+            b.time_slot,
+            b.status,
+            b.price
+        FROM bookings b
+        LEFT JOIN users u ON u.user_id = b.user_id
+        {where_sql}
+        ORDER BY b.date {order}, b.time_slot {order}, b.id {order}
+        LIMIT ?
+    ''', (*params, limit)).fetchall()
+
+
+# Страница броней и есть ли страницы до/после неё
+def get_bookings_page(filter_key: str, cursor: Optional[tuple] = None, backward: bool = False) -> tuple:
+    with db.connection() as conn:
+        rows = _select_admin_bookings(conn, filter_key, cursor, backward, ADMIN_PAGE_SIZE + 1)
+    more = len(rows) > ADMIN_PAGE_SIZE  # лишняя строка — признак ещё одной страницы в ту же сторону
+    rows = rows[:ADMIN_PAGE_SIZE]
+    if backward:
+        return rows[::-1], more, cursor is not None
+    return rows, cursor is not None, more
+
+
+# Все брони по фильтру одним CSV (как выгрузка веб-админки); читаем кусками по ключу
+def build_bookings_csv(filter_key: str) -> tuple:
+    buffer = io.BytesIO()
+    text = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')  # BOM, чтобы Excel открыл UTF-8
+    writer = csv.writer(text, delimiter=';')
+    writer.writerow(ADMIN_EXPORT_COLUMNS)
+    count, cursor = 0, None
+    with db.connection() as conn:
+        while True:
+            rows = _select_admin_bookings(conn, filter_key, cursor, False, ADMIN_EXPORT_CHUNK)
+            for row in rows:
+                writer.writerow([row['id'], row['username'], row['first_name'], row['specialization'],
+                                 row['direction'], row['instrument'], row['date'], row['time_slot'],
+                                 row['status'], row['price']])
+            count += len(rows)
+            if len(rows) < ADMIN_EXPORT_CHUNK:
+                break
+            cursor = (rows[-1]['date'], rows[-1]['time_slot'], rows[-1]['id'])
+    text.detach()  # иначе при сборке мусора обёртка закроет и buffer
+    return buffer.getvalue(), count
+
+
+# --- Установить цену, вернуть актуальное значение из базы ---
+def set_price(spec: str, dir: str, new_price: float) -> float:
+    global _price_cache_version
+    with db.transaction() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO prices (specialization, direction, price)
+            VALUES (?, ?, ?)
+        ''', (spec, dir, new_price))
+
+        # Проверка
+        row = conn.execute(
+            'SELECT price FROM prices WHERE specialization = ? AND direction = ?', (spec, dir)
+        ).fetchone()
+        version = db.get_data_version(conn, 'prices')
+
+    # Сразу обновляем кэш, не дожидаясь следующей сверки с базой
+    with _price_cache_lock:
+        _price_cache[(spec, dir)] = row[0]
+        if _price_cache_version is not None and version == _price_cache_version + 1:
+            _price_cache_version = version
+        menus.rebuild(_price_cache)
+    return row[0]
+
+
+# --- Напоминания: храним в scheduled_jobs, в памяти держим только ближайшее окно ---
+_queued_reminders = set()  # id задач из scheduled_jobs, уже поставленных в job_queue
+
+
+# Операция для db.GroupCommitWriter
+def _insert_reminder(conn, booking_id: int, run_at: datetime) -> int:
+    c = conn.execute('''
+        INSERT INTO scheduled_jobs (kind, booking_id, run_at) VALUES ('reminder', ?, ?)
+    ''', (booking_id, run_at.strftime('%Y-%m-%d %H:%M:%S')))
+    return c.lastrowid
+
+
+# --- Напоминания до конца окна вместе с данными брони (один запрос) ---
+def load_due_reminders(window_end: datetime) -> list:
+    now = datetime.now()
+    with db.transaction() as conn:
+        # Если бот лежал дольше, чем за час до занятия, напоминать уже поздно
+        conn.execute('''
+            UPDATE scheduled_jobs SET status = 'missed'
+            WHERE status = 'pending' AND run_at < ?
+        ''', ((now - timedelta(hours=REMINDER_LEAD_HOURS)).strftime('%Y-%m-%d %H:%M:%S'),))
+        rows = conn.execute('''
+            SELECT j.id AS job_id, j.run_at, b.id AS booking_id, b.user_id, b.date, b.time_slot,
+                   b.direction, b.instrument
+            FROM scheduled_jobs j
+            JOIN bookings b ON b.id = j.booking_id
+            WHERE j.status = 'pending' AND j.kind = 'reminder' AND j.run_at < ?
+              AND b.status = 'confirmed' AND b.user_id % ? = ?
+            ORDER BY j.run_at
+        ''', (window_end.strftime('%Y-%m-%d %H:%M:%S'), SHARD_COUNT, SHARD_INDEX)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def mark_scheduled_job(job_id: int, status: str):
+    with db.transaction() as conn:
+        conn.execute('UPDATE scheduled_jobs SET status = ? WHERE id = ?', (status, job_id))
+
+
+# Бронь могли отменить уже после того, как напоминание встало в job_queue
+def cancel_reminder_if_inactive(job_id: int) -> bool:
+    with db.transaction() as conn:
+        c = conn.execute('''
+            UPDATE scheduled_jobs SET status = 'cancelled'
+            WHERE id = ? AND NOT EXISTS (
+                SELECT 1 FROM bookings b WHERE b.id = scheduled_jobs.booking_id AND b.status = 'confirmed'
+            )
+        ''', (job_id,))
+    return c.rowcount > 0
+
+
+def queue_reminder(job_queue, reminder: dict):
+    if reminder['job_id'] in _queued_reminders:
+        return
+    _queued_reminders.add(reminder['job_id'])
+    run_at = datetime.strptime(reminder['run_at'], '%Y-%m-%d %H:%M:%S')
+    job_queue.run_once(
+        send_reminder,
+        when=max((run_at - datetime.now()).total_seconds(), 0),
+        data=reminder,
+        name=f"reminder_{reminder['job_id']}",
+    )
+
+
+# --- Периодически подгружаем напоминания на следующие REMINDER_WINDOW_HOURS ---
+async def refill_reminders_job(context: ContextTypes.DEFAULT_TYPE):
+    window_end = datetime.now() + timedelta(hours=REMINDER_WINDOW_HOURS)
+    reminders = await db.run(load_due_reminders, window_end)
+    for reminder in reminders:
+        queue_reminder(context.job_queue, reminder)
+    logger.info(f"Напоминаний в очереди: {len(_queued_reminders)} (до {window_end:%d.%m %H:%M})")
+
+
 # --- Отправить напоминание за 1 час ---
 async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
     job = context.job
-    booking_id = job.data['booking_id']
-    booking = get_booking_by_id(booking_id)
-    if not booking or booking['status'] != 'confirmed':
+    reminder = job.data
+    booking_id = reminder['booking_id']
+
+    if await db.run(cancel_reminder_if_inactive, reminder['job_id']):
+        logger.info(f"Бронь #{booking_id} больше не подтверждена, напоминание не отправлено")
+        _queued_reminders.discard(reminder['job_id'])
         return
 
-    user_id = booking['user_id']
-    date = booking['date']
-    time_slot = booking['time_slot']
-    direction = booking['direction']
-    instrument = booking.get('instrument') or ''
+    user_id = reminder['user_id']
+    date = reminder['date']
+    time_slot = reminder['time_slot']
+    direction = reminder['direction']
+    instrument = reminder.get('instrument') or ''
 
     text = f"🔔 Напоминание!\n\nВы записаны на занятие:\n📅 {date}\n⏰ {time_slot}\n🎯 {direction}"
     if instrument:
@@ -235,10 +682,16 @@ async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
     text += "\n\n📍 Адрес: ул. Музыкальная, д. 5, каб. 203\n📞 Контакт: +7 (XXX) XXX-XX-XX\n\nПриходите за 10 минут!"
 
     try:
-        await context.bot.send_message(chat_id=user_id, text=text)
+        # Через общую очередь: лимиты Telegram и повторы при 429 учитывает она
+        await context.bot_data['outbox'].send(chat_id=user_id, text=text)
         logger.info(f"Напоминание отправлено пользователю {user_id} о брони #{booking_id}")
+        status = 'sent'
     except Exception as e:
         logger.error(f"Не удалось отправить напоминание: {e}")
+        status = 'failed'
+
+    await db.run(mark_scheduled_job, reminder['job_id'], status)
+    _queued_reminders.discard(reminder['job_id'])
 
 
 # --- Команда /start ---
@@ -249,18 +702,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     first_name = user.first_name or ""
     language_code = user.language_code or ""
 
-    # Сохраняем пользователя в базу
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        INSERT OR IGNORE INTO users (user_id, username, first_name, language_code)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, username, first_name, language_code))
-    conn.commit()
-    conn.close()
-
-    keyboard = [[InlineKeyboardButton("🎹 Выбрать специализацию", callback_data='select_spec')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Сохраняем пользователя в базу (в фоне, пачкой)
+    remember_user(user_id, username, first_name, language_code)
+
+    reply_markup = menus.get('start')
 
     await update.message.reply_text(
         "Привет! 👋\nДобро пожаловать в студию музыкального образования!\n\n"
@@ -273,15 +718,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Обработчик выбора специализации ---
 async def select_specialization(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] select_specialization вызван")
     await query.answer()
 
-    keyboard = [
-        [InlineKeyboardButton("🎼 Соло", callback_data='spec_solo')],
-        [InlineKeyboardButton("💞 Дуэт", callback_data='spec_duet')],
-        [InlineKeyboardButton("🎻 Ансамбль (3+)", callback_data='spec_ensemble')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = menus.get('specializations')
 
     await query.edit_message_text(
         "Выберите тип занятия:",
@@ -293,21 +732,12 @@ async def select_specialization(update: Update, context: ContextTypes.DEFAULT_TY
 # --- Обработчик выбора направления ---
 async def select_direction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] select_direction вызван. data='{query.data}'")
     await query.answer()
 
     spec = query.data.split('_')[1]  # spec_solo → 'solo'
     context.user_data['specialization'] = spec
 
-    keyboard = [
-        [InlineKeyboardButton("🥁 Ударные", callback_data='dir_percussion')],
-        [InlineKeyboardButton("🎻 Струнные", callback_data='dir_strings')],
-        [InlineKeyboardButton("🎷 Духовые", callback_data='dir_brass')],
-        [InlineKeyboardButton("🎹 Фортепиано", callback_data='dir_piano')],
-        [InlineKeyboardButton("🎤 Вокал", callback_data='dir_vocal')],
-        [InlineKeyboardButton("🎶 Микс", callback_data='dir_mix')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = menus.get('directions')
 
     await query.edit_message_text(
         "Выберите направление:",
@@ -319,21 +749,13 @@ async def select_direction(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Обработчик выбора инструмента (если ударные) ---
 async def select_instrument(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] select_instrument вызван. data='{query.data}'")
     await query.answer()
 
     direction = query.data.split('_')[1]  # dir_percussion → 'percussion'
     context.user_data['direction'] = direction
 
-    if direction == 'percussion':
-        keyboard = [
-            [InlineKeyboardButton("🥁 Барабаны", callback_data='inst_drums')],
-            [InlineKeyboardButton("🥁 Перкуссия", callback_data='inst_percc')],
-            [InlineKeyboardButton("🥁 Тимпаны", callback_data='inst_timpani')],
-            [InlineKeyboardButton("🥁 Электронные ударные", callback_data='inst_electronic')],
-            [InlineKeyboardButton("🥁 Все вышеперечисленное", callback_data='inst_all')],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    if direction in menus.INSTRUMENTS:
+        reply_markup = menus.get(f'instruments_{direction}')
         await query.edit_message_text(
             "Выберите конкретный инструмент:",
             reply_markup=reply_markup
@@ -348,7 +770,6 @@ async def select_instrument(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Обработчик выбора инструмента (после выбора) ---
 async def handle_instrument_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] handle_instrument_choice вызван. data='{query.data}'")
     await query.answer()
 
     instrument = query.data.split('_')[1]
@@ -360,21 +781,16 @@ async def handle_instrument_choice(update: Update, context: ContextTypes.DEFAULT
 # --- Календарь (выбор даты) ---
 async def select_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] select_date вызван")
     await query.answer()
 
-    today = datetime.today()
-    dates = []
-    for i in range(14):
-        d = today + timedelta(days=i)
-        date_str = d.strftime('%Y-%m-%d')
-        dates.append((d.strftime('%d.%m'), date_str))
+    dates = [(d.strftime('%d.%m'), d.strftime('%Y-%m-%d')) for d in schedule.booking_dates()]
+
+    slots_by_date = await db.run(get_available_slots_range, [date_str for _, date_str in dates])
 
     keyboard = []
     row = []
     for label, date_str in dates:
-        available_slots = get_available_slots(date_str)
-        if available_slots:
+        if slots_by_date[date_str]:
             row.append(InlineKeyboardButton(label, callback_data=f'date_{date_str}'))
         else:
             row.append(InlineKeyboardButton(f"{label} 🚫", callback_data='ignore'))
@@ -395,10 +811,29 @@ async def select_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return SELECT_DATE
 
 
+# --- Клавиатура свободного времени на дату ---
+def build_time_keyboard(slots: list, prefix: str = '', back_data: str = 'back_to_dates') -> InlineKeyboardMarkup:
+    keyboard = [[InlineKeyboardButton(slot, callback_data=f'{prefix}time_{slot}')] for slot in slots]
+    keyboard.append([InlineKeyboardButton("← Назад к датам", callback_data=back_data)])
+    return InlineKeyboardMarkup(keyboard)
+
+
+# --- Слот заняли, пока пользователь выбирал: показать актуальное время ---
+async def show_slot_taken(query, date: str, time_slot: str, prefix: str = '', back_data: str = 'back_to_dates'):
+    slots = await db.run(get_available_slots, date)
+    if slots:
+        text = f"⚠️ Время {time_slot} только что заняли.\n\nСвободное время на {date}:"
+    else:
+        text = f"⚠️ Время {time_slot} только что заняли, на {date} свободных слотов больше нет."
+    await query.edit_message_text(
+        text,
+        reply_markup=build_time_keyboard(slots, prefix=prefix, back_data=back_data)
+    )
+
+
 # --- Обработка выбора даты ---
 async def handle_date_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] handle_date_choice вызван. data='{query.data}'")
     await query.answer()
 
     if query.data == 'back_to_dir':
@@ -409,17 +844,12 @@ async def handle_date_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         date_str = query.data.split('_')[1]
         context.user_data['selected_date'] = date_str
 
-        slots = get_available_slots(date_str)
+        slots = await db.run(get_available_slots, date_str)
         if not slots:
             await query.edit_message_text("На эту дату нет свободных слотов. Попробуйте другую.")
             return SELECT_DATE
 
-        keyboard = []
-        for slot in slots:
-            keyboard.append([InlineKeyboardButton(slot, callback_data=f'time_{slot}')])
-
-        keyboard.append([InlineKeyboardButton("← Назад к датам", callback_data='back_to_dates')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = build_time_keyboard(slots)
 
         await query.edit_message_text(
             f"Выбрана дата: {date_str}\n\nВыберите время:",
@@ -431,7 +861,6 @@ async def handle_date_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # --- Обработка выбора времени ---
 async def handle_time_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] handle_time_choice вызван. data='{query.data}'")
     await query.answer()
 
     if query.data == 'back_to_dates':
@@ -447,7 +876,8 @@ async def handle_time_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         inst = context.user_data.get('instrument') or ''
         date = context.user_data['selected_date']
 
-        booking_id = save_booking(
+        booking_id = await save_booking(
+            context.bot_data['writer'],
             user_id=query.from_user.id,
             spec=spec,
             dir=dir,
@@ -455,9 +885,13 @@ async def handle_time_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
             date=date,
             time_slot=time_slot
         )
+        if booking_id is None:
+            await show_slot_taken(query, date, time_slot)
+            return SELECT_TIME
+        schedule_booking_expiry(context.job_queue, booking_id)
         context.user_data['booking_id'] = booking_id
 
-        booking = get_booking_by_id(booking_id)
+        booking = await db.run(get_booking_by_id, booking_id)
         price = booking['price']
 
         text = (
@@ -474,11 +908,7 @@ async def handle_time_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         text += f"[Оплатить {price}₽](https://example.com/pay?booking={booking_id})\n\n"
         text += "⚠️ Внимание: слот будет зарезервирован на 15 минут. Если оплата не пройдёт — место освободится."
 
-        keyboard = [
-            [InlineKeyboardButton("✅ Я оплатил", callback_data='confirm_payment')],
-            [InlineKeyboardButton("❌ Отменить", callback_data='cancel_booking')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = menus.get('payment')
 
         await query.edit_message_text(
             text,
@@ -492,7 +922,6 @@ async def handle_time_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # --- Подтверждение оплаты ---
 async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] confirm_payment вызван")
     await query.answer()
 
     booking_id = context.user_data.get('booking_id')
@@ -500,16 +929,36 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Ошибка: бронь не найдена.")
         return
 
-    update_booking_status(booking_id, "confirmed")
-    booking = get_booking_by_id(booking_id)
+    confirmed = await update_booking_status(context.bot_data['writer'], booking_id, "confirmed")
+    booking = await db.run(get_booking_by_id, booking_id)
+    if not confirmed and (not booking or booking['status'] != 'confirmed'):
+        context.user_data.clear()
+        await query.edit_message_text(
+            f"⌛ Время на оплату ({PAYMENT_TIMEOUT_MINUTES} минут) истекло, слот освобождён.\n\n"
+            "Чтобы записаться, начните бронирование заново:",
+            reply_markup=menus.get('start')
+        )
+        return SELECT_SPECIALIZATION
+    cancel_booking_expiry(context.job_queue, booking_id)
 
     booking_datetime = datetime.strptime(f"{booking['date']} {booking['time_slot']}", "%Y-%m-%d %H:%M")
-    reminder_time = booking_datetime - timedelta(hours=1)
+    reminder_time = booking_datetime - timedelta(hours=REMINDER_LEAD_HOURS)
     now = datetime.now()
-    delay = (reminder_time - now).total_seconds()
 
-    if delay > 0:
-        context.job_queue.run_once(send_reminder, when=delay, data={'booking_id': booking_id})
+    # Повторное нажатие "Я оплатил" бронь уже не меняет — второе напоминание не нужно
+    if confirmed and reminder_time > now:
+        job_id = await context.bot_data['writer'].submit(_insert_reminder, booking_id, reminder_time)
+        if reminder_time < now + timedelta(hours=REMINDER_WINDOW_HOURS):
+            queue_reminder(context.job_queue, {
+                'job_id': job_id,
+                'run_at': reminder_time.strftime('%Y-%m-%d %H:%M:%S'),
+                'booking_id': booking_id,
+                'user_id': booking['user_id'],
+                'date': booking['date'],
+                'time_slot': booking['time_slot'],
+                'direction': booking['direction'],
+                'instrument': booking['instrument'],
+            })
 
     await query.edit_message_text(
         f"✅ ЗАБРОНИРОВАНО!\n\n"
@@ -528,16 +977,15 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Отмена брони ---
 async def cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] cancel_booking вызван")
     await query.answer()
 
     booking_id = context.user_data.get('booking_id')
     if booking_id:
-        update_booking_status(booking_id, "cancelled")
+        await update_booking_status(context.bot_data['writer'], booking_id, "cancelled")
+        cancel_booking_expiry(context.job_queue, booking_id)
         context.user_data.clear()
 
-    keyboard = [[InlineKeyboardButton("🎹 Выбрать специализацию", callback_data='select_spec')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = menus.get('start')
 
     await query.edit_message_text(
         "❌ Бронь отменена. Слот освобождён.\n\n"
@@ -550,17 +998,7 @@ async def cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Команда /mybookings ---
 async def my_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('''
-        SELECT date, time_slot, direction, instrument, status 
-        FROM bookings 
-        WHERE user_id = ? AND status IN ('confirmed', 'pending_payment') 
-        ORDER BY date, time_slot
-    ''', (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    rows = await db.run(get_user_bookings, user_id)
 
     if not rows:
         await update.message.reply_text("У вас нет активных броней.")
@@ -585,12 +1023,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return  # 👈 НИЧЕГО НЕ ВЫВОДИМ — ПОЛЬЗОВАТЕЛЬ НЕ ВИДИТ МЕНЮ!
 
     # 👇 ТОЛЬКО ДЛЯ АДМИНА — ПОКАЗЫВАЕМ МЕНЮ
-    keyboard = [
-        [InlineKeyboardButton("📊 Просмотр всех броней", callback_data='admin_view_bookings')],
-        [InlineKeyboardButton("➕ Забронировать без оплаты", callback_data='admin_create_booking')],
-        [InlineKeyboardButton("💰 Изменить цену", callback_data='admin_change_price')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = menus.get('admin')
 
     await update.message.reply_text(
         "🔐 Админ-панель:\n\nВыберите действие:",
@@ -598,64 +1031,112 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-# --- Админ: просмотр всех броней ---
+# --- Админ: просмотр броней по страницам ---
+# callback_data: admin_bk:<фильтр>[:<n|p>:<date>|<time_slot>|<id>] — фильтр и ключ страницы;
+# n — брони старше ключа (вперёд), p — новее (назад)
+def _admin_bookings_keyboard(filter_key: str, rows: list, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    filter_buttons = [
+        InlineKeyboardButton(f"• {title}" if key == filter_key else title, callback_data=f'admin_bk:{key}')
+        for key, title in ADMIN_BOOKING_FILTERS
+    ]
+    keyboard = [filter_buttons[:2], filter_buttons[2:]]
+
+    nav = []
+    if has_prev:
+        first = rows[0]
+        nav.append(InlineKeyboardButton(
+            "◀️ Назад", callback_data=f"admin_bk:{filter_key}:p:{first['date']}|{first['time_slot']}|{first['id']}"
+        ))
+    if has_next:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton(
+            "Вперёд ▶️", callback_data=f"admin_bk:{filter_key}:n:{last['date']}|{last['time_slot']}|{last['id']}"
+        ))
+    if nav:
+        keyboard.append(nav)
+
+    keyboard.append([InlineKeyboardButton("📄 Все брони файлом", callback_data=f'admin_bk_file:{filter_key}')])
+    keyboard.append([InlineKeyboardButton("← Назад в админку", callback_data='admin_back')])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def _parse_admin_bookings_data(data: str) -> tuple:
+    parts = data.split(':', 3)  # admin_view_bookings (из меню админки) — первая страница всех броней
+    filter_key = parts[1] if len(parts) > 1 and parts[1] in dict(ADMIN_BOOKING_FILTERS) else 'all'
+    if len(parts) < 4:
+        return filter_key, None, False
+    try:
+        date, time_slot, booking_id = parts[3].split('|')
+        return filter_key, (date, time_slot, int(booking_id)), parts[2] == 'p'
+    except ValueError:
+        return filter_key, None, False
+
+
 async def admin_view_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_view_bookings вызван")
+    if query.from_user.id != ADMIN_ID:
+        await query.answer("❌ Доступ запрещён", show_alert=True)
+        return
     await query.answer()
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('''
-        SELECT 
-            b.id, 
-            u.username, 
-            b.specialization, 
-            b.direction, 
-            b.instrument, 
-            b.date, 
-            b.time_slot, 
-            b.status
-        FROM bookings b
-        LEFT JOIN (SELECT DISTINCT user_id, username FROM users) u ON b.user_id = u.user_id
-        ORDER BY b.date DESC, b.time_slot DESC
-    ''')
-    rows = c.fetchall()
-    conn.close()
+    filter_key, cursor, backward = _parse_admin_bookings_data(query.data)
+    rows, has_prev, has_next = await db.run(get_bookings_page, filter_key, cursor, backward)
+    if not rows and cursor:
+        # Страница опустела (брони удалили) — начинаем с первой
+        cursor = None
+        rows, has_prev, has_next = await db.run(get_bookings_page, filter_key)
 
+    title = dict(ADMIN_BOOKING_FILTERS)[filter_key]
     if not rows:
-        await query.edit_message_text("📭 Нет броней.")
-        return
+        text = f"📋 Брони — {title}\n\n📭 Нет броней."
+    else:
+        text = f"📋 Брони — {title}:\n\n"
+        for row in rows:
+            username = row['username'] if row['username'] is not None else f"ID:{row['user_id']}"
+            status_emoji = "✅" if row['status'] == 'confirmed' else "⏳" if row['status'] == 'pending_payment' else "❌"
+            inst_text = f" ({row['instrument']})" if row['instrument'] else ""
 
-    text = "📋 Все брони:\n\n"
-    for row in rows:
-        username = row['username'] if row['username'] is not None else f"ID:{row['user_id']}"
-        status_emoji = "✅" if row['status'] == 'confirmed' else "⏳" if row['status'] == 'pending_payment' else "❌"
-        instrument = row['instrument'] if 'instrument' in row and row['instrument'] is not None else ""
-        inst_text = f" ({instrument})" if instrument else ""
+            text += f"{status_emoji} {row['date']} {row['time_slot']} — {row['specialization']} | {row['direction']}{inst_text}\n"
+            text += f"   👤 {username}\n"
 
-        text += f"{status_emoji} {row['date']} {row['time_slot']} — {row['specialization']} | {row['direction']}{inst_text}\n"
-        text += f"   👤 {username}\n"
+    reply_markup = _admin_bookings_keyboard(filter_key, rows, has_prev, has_next)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Повторное нажатие того же фильтра — сообщение не изменилось
+        if 'not modified' not in str(e):
+            raise
 
-    keyboard = [[InlineKeyboardButton("← Назад в админку", callback_data='admin_back')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await query.edit_message_text(text, reply_markup=reply_markup)
+# --- Админ: все брони по фильтру документом ---
+async def admin_bookings_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.from_user.id != ADMIN_ID:
+        await query.answer("❌ Доступ запрещён", show_alert=True)
+        return
+
+    filter_key, _, _ = _parse_admin_bookings_data(query.data)
+    content, count = await db.run(build_bookings_csv, filter_key)
+    if not count:
+        await query.answer("📭 Нет броней.", show_alert=True)
+        return
+    await query.answer()
+
+    title = dict(ADMIN_BOOKING_FILTERS)[filter_key]
+    await context.bot.send_document(
+        chat_id=query.message.chat_id,
+        document=content,
+        filename=f"bookings_{filter_key}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+        caption=f"📄 Брони — {title}: {count}",
+    )
 
 
 # --- Админ: начать создание брони ---
 async def admin_start_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_start_booking вызван. data='{query.data}'")
     await query.answer()
 
-    keyboard = [
-        [InlineKeyboardButton("🎼 Соло", callback_data='admin_spec_solo')],
-        [InlineKeyboardButton("💞 Дуэт", callback_data='admin_spec_duet')],
-        [InlineKeyboardButton("🎻 Ансамбль (3+)", callback_data='admin_spec_ensemble')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = menus.get('admin_specializations')
 
     await query.edit_message_text(
         "🔹 Выберите тип занятия:",
@@ -667,21 +1148,12 @@ async def admin_start_booking(update: Update, context: ContextTypes.DEFAULT_TYPE
 # --- Админ: выбор направления ---
 async def admin_select_direction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_select_direction вызван. data='{query.data}'")
     await query.answer()
 
     spec = query.data.split('_')[2]  # admin_spec_solo → 'solo'
     context.user_data['admin_spec'] = spec
 
-    keyboard = [
-        [InlineKeyboardButton("🥁 Ударные", callback_data='admin_dir_percussion')],
-        [InlineKeyboardButton("🎻 Струнные", callback_data='admin_dir_strings')],
-        [InlineKeyboardButton("🎷 Духовые", callback_data='admin_dir_brass')],
-        [InlineKeyboardButton("🎹 Фортепиано", callback_data='admin_dir_piano')],
-        [InlineKeyboardButton("🎤 Вокал", callback_data='admin_dir_vocal')],
-        [InlineKeyboardButton("🎶 Микс", callback_data='admin_dir_mix')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = menus.get('admin_directions')
 
     await query.edit_message_text(
         "🔹 Выберите направление:",
@@ -693,21 +1165,13 @@ async def admin_select_direction(update: Update, context: ContextTypes.DEFAULT_T
 # --- Админ: выбор инструмента (если ударные) ---
 async def admin_select_instrument(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_select_instrument вызван. data='{query.data}'")
     await query.answer()
 
     direction = query.data.split('_')[2]  # admin_dir_percussion → 'percussion'
     context.user_data['admin_dir'] = direction
 
-    if direction == 'percussion':
-        keyboard = [
-            [InlineKeyboardButton("🥁 Барабаны", callback_data='admin_inst_drums')],
-            [InlineKeyboardButton("🥁 Перкуссия", callback_data='admin_inst_percc')],
-            [InlineKeyboardButton("🥁 Тимпаны", callback_data='admin_inst_timpani')],
-            [InlineKeyboardButton("🥁 Электронные ударные", callback_data='admin_inst_electronic')],
-            [InlineKeyboardButton("🥁 Все вышеперечисленное", callback_data='admin_inst_all')],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    if direction in menus.INSTRUMENTS:
+        reply_markup = menus.get(f'admin_instruments_{direction}')
         await query.edit_message_text(
             "🔹 Выберите инструмент:",
             reply_markup=reply_markup
@@ -722,7 +1186,6 @@ async def admin_select_instrument(update: Update, context: ContextTypes.DEFAULT_
 # --- Админ: обработка выбора инструмента ---
 async def admin_handle_instrument_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_handle_instrument_choice вызван. data='{query.data}'")
     await query.answer()
 
     instrument = query.data.split('_')[2]
@@ -734,15 +1197,9 @@ async def admin_handle_instrument_choice(update: Update, context: ContextTypes.D
 # --- Админ: выбор даты ---
 async def admin_select_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_select_date вызван")
     await query.answer()
 
-    today = datetime.today()
-    dates = []
-    for i in range(14):
-        d = today + timedelta(days=i)
-        date_str = d.strftime('%Y-%m-%d')
-        dates.append((d.strftime('%d.%m'), date_str))
+    dates = [(d.strftime('%d.%m'), d.strftime('%Y-%m-%d')) for d in schedule.booking_dates()]
 
     keyboard = []
     row = []
@@ -767,7 +1224,6 @@ async def admin_select_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Админ: выбор времени ---
 async def admin_handle_date_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_handle_date_choice вызван. data='{query.data}'")
     await query.answer()
 
     if query.data == 'admin_back_to_spec':
@@ -778,17 +1234,12 @@ async def admin_handle_date_choice(update: Update, context: ContextTypes.DEFAULT
         date_str = query.data.split('_')[2]
         context.user_data['admin_date'] = date_str
 
-        slots = get_available_slots(date_str)
+        slots = await db.run(get_available_slots, date_str)
         if not slots:
             await query.edit_message_text("На эту дату нет свободных слотов.")
             return ADMIN_SELECT_DATE
 
-        keyboard = []
-        for slot in slots:
-            keyboard.append([InlineKeyboardButton(slot, callback_data=f'admin_time_{slot}')])
-
-        keyboard.append([InlineKeyboardButton("← Назад к датам", callback_data='admin_back_to_date')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = build_time_keyboard(slots, prefix='admin_', back_data='admin_back_to_date')
 
         await query.edit_message_text(
             f"🔹 Выбрана дата: {date_str}\n\nВыберите время:",
@@ -800,7 +1251,6 @@ async def admin_handle_date_choice(update: Update, context: ContextTypes.DEFAULT
 # --- Админ: подтверждение брони без оплаты ---
 async def admin_handle_time_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_handle_time_choice вызван. data='{query.data}'")
     await query.answer()
 
     if query.data == 'admin_back_to_date':
@@ -814,7 +1264,8 @@ async def admin_handle_time_choice(update: Update, context: ContextTypes.DEFAULT
         inst = context.user_data.get('admin_inst') or ''
         date = context.user_data['admin_date']
 
-        booking_id = save_booking(
+        booking_id = await save_booking(
+            context.bot_data['writer'],
             user_id=ADMIN_ID,
             spec=spec,
             dir=dir,
@@ -823,7 +1274,10 @@ async def admin_handle_time_choice(update: Update, context: ContextTypes.DEFAULT
             time_slot=time_slot,
             status='confirmed'
         )
-        price = get_price(spec, dir)
+        if booking_id is None:
+            await show_slot_taken(query, date, time_slot, prefix='admin_', back_data='admin_back_to_date')
+            return ADMIN_SELECT_TIME
+        price = await db.run(get_price, spec, dir)
 
         text = (
             f"✅ АДМИН БРОНИРОВАЛ БЕЗ ОПЛАТЫ!\n\n"
@@ -835,8 +1289,7 @@ async def admin_handle_time_choice(update: Update, context: ContextTypes.DEFAULT
             f"👤 Забронировал: Админ"
         )
 
-        keyboard = [[InlineKeyboardButton("← Назад в админку", callback_data='admin_back')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = menus.get('admin_back')
 
         await query.edit_message_text(text, reply_markup=reply_markup)
         return ConversationHandler.END
@@ -845,30 +1298,10 @@ async def admin_handle_time_choice(update: Update, context: ContextTypes.DEFAULT
 # --- Админ: выбрать цену для пары (спец + направление) ---
 async def admin_change_price_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_change_price_menu вызван")
     await query.answer()
 
-    keyboard = [
-        [InlineKeyboardButton("🎼 Соло — Ударные", callback_data='admin_price_solo_percussion')],
-        [InlineKeyboardButton("🎼 Соло — Струнные", callback_data='admin_price_solo_strings')],
-        [InlineKeyboardButton("🎼 Соло — Фортепиано", callback_data='admin_price_solo_piano')],
-        [InlineKeyboardButton("🎼 Соло — Вокал", callback_data='admin_price_solo_vocal')],
-        [InlineKeyboardButton("🎼 Соло — Микс", callback_data='admin_price_solo_mix')],
-
-        [InlineKeyboardButton("💞 Дуэт — Ударные", callback_data='admin_price_duet_percussion')],
-        [InlineKeyboardButton("💞 Дуэт — Струнные", callback_data='admin_price_duet_strings')],
-        [InlineKeyboardButton("💞 Дуэт — Фортепиано", callback_data='admin_price_duet_piano')],
-        [InlineKeyboardButton("💞 Дуэт — Вокал", callback_data='admin_price_duet_vocal')],
-        [InlineKeyboardButton("💞 Дуэт — Микс", callback_data='admin_price_duet_mix')],
-
-        [InlineKeyboardButton("🎻 Ансамбль — Ударные", callback_data='admin_price_ensemble_percussion')],
-        [InlineKeyboardButton("🎻 Ансамбль — Струнные", callback_data='admin_price_ensemble_strings')],
-        [InlineKeyboardButton("🎻 Ансамбль — Фортепиано", callback_data='admin_price_ensemble_piano')],
-        [InlineKeyboardButton("🎻 Ансамбль — Вокал", callback_data='admin_price_ensemble_vocal')],
-        [InlineKeyboardButton("🎻 Ансамбль — Микс", callback_data='admin_price_ensemble_mix')],
-    ]
-    keyboard.append([InlineKeyboardButton("← Назад", callback_data='admin_back')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    await db.run(check_price_cache)  # цену могли поменять из веб-админки
+    reply_markup = menus.get('admin_prices')
 
     await query.edit_message_text(
         "💰 Выберите комбинацию для изменения цены:",
@@ -879,15 +1312,9 @@ async def admin_change_price_menu(update: Update, context: ContextTypes.DEFAULT_
 # --- Админ: назад в меню ---
 async def admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_back вызван")
     await query.answer()
 
-    keyboard = [
-        [InlineKeyboardButton("📊 Просмотр всех броней", callback_data='admin_view_bookings')],
-        [InlineKeyboardButton("➕ Забронировать без оплаты", callback_data='admin_create_booking')],
-        [InlineKeyboardButton("💰 Изменить цену", callback_data='admin_change_price')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = menus.get('admin')
 
     await query.edit_message_text(
         "🔐 Админ-панель:\n\nВыберите действие:",
@@ -898,7 +1325,6 @@ async def admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # --- Админ: ввести новую цену ---
 async def admin_set_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    print(f"🔥 [DEBUG] admin_set_price вызван. data='{query.data}'")
     await query.answer()
 
     data = query.data
@@ -906,7 +1332,7 @@ async def admin_set_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['price_spec'] = spec
     context.user_data['price_dir'] = dir
 
-    current_price = get_price(spec, dir)
+    current_price = await db.run(get_price, spec, dir)
     await query.edit_message_text(
         f"Текущая цена: {current_price} ₽\n\n"
         f"Введите новую цену (число, например: 900):\n\n"
@@ -917,7 +1343,6 @@ async def admin_set_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- Обработка ввода цены ---
 async def handle_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print(f"🔥 [DEBUG] handle_price_input вызван. Текст: '{update.message.text}'")
     try:
         new_price = float(update.message.text.strip())
         if new_price < 0:
@@ -929,22 +1354,8 @@ async def handle_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     spec = context.user_data['price_spec']
     dir = context.user_data['price_dir']
 
-    print(f"🔧 [DEBUG] Обновляем цену: spec='{spec}', dir='{dir}', price={new_price}")
-
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        INSERT OR REPLACE INTO prices (specialization, direction, price)
-        VALUES (?, ?, ?)
-    ''', (spec, dir, new_price))
-    conn.commit()
-
-    # Проверка
-    c.execute('SELECT price FROM prices WHERE specialization = ? AND direction = ?', (spec, dir))
-    row = c.fetchone()
-    actual_price = row[0]
-    print(f"✅ [DEBUG] Актуальная цена после обновления: {actual_price}")
-    conn.close()
+    actual_price = await db.run(set_price, spec, dir, new_price)
+    logger.debug(f"Цена {spec} | {dir}: {new_price} → в базе {actual_price}")
 
     await update.message.reply_text(
         f"✅ Цена успешно изменена!\n\n"
@@ -952,12 +1363,7 @@ async def handle_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
 
     # Вернём в админку
-    keyboard = [
-        [InlineKeyboardButton("📊 Просмотр всех броней", callback_data='admin_view_bookings')],
-        [InlineKeyboardButton("➕ Забронировать без оплаты", callback_data='admin_create_booking')],
-        [InlineKeyboardButton("💰 Изменить цену", callback_data='admin_change_price')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = menus.get('admin')
 
     await update.message.reply_text(
         "🔐 Админ-панель:\n\nВыберите действие:",
@@ -972,10 +1378,90 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error: {context.error}")
 
 
-# --- Главная функция ---
-def main():
-    init_db()
-    app = Application.builder().token(BOT_TOKEN).build()
+# --- Запуск: очередь исходящих сообщений ---
+async def on_startup(app: Application):
+    # Лимит Telegram общий на бота — воркеры делят его поровну
+    app.bot_data['outbox'] = MessageDispatcher(app.bot, global_rate=GLOBAL_RATE / SHARD_COUNT)
+    await app.bot_data['outbox'].start()
+    app.bot_data['writer'] = db.GroupCommitWriter()
+    await app.bot_data['writer'].start()
+    if METRICS_PORT:
+        app.bot_data['metrics_server'] = metrics.start_http_server(METRICS_PORT, METRICS_HOST)
+
+
+# --- Остановка: дождаться отправки и записей в БД, закрыть соединения ---
+async def on_shutdown(app: Application):
+    await app.bot_data['writer'].stop()
+    await app.bot_data['outbox'].stop()
+    if 'metrics_server' in app.bot_data:
+        app.bot_data['metrics_server'].shutdown()
+    await db.run(flush_users)
+    db.shutdown_executor()
+    db.close_pool()
+
+
+# --- Замер времени всех обработчиков, включая вложенные в ConversationHandler ---
+def instrument_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        elif not getattr(handler.callback, 'timed', False):
+            handler.callback = metrics.timed_handler(handler.callback)
+
+
+# --- Параллельно для разных пользователей, по очереди для одного ---
+# ConversationHandler не рассчитан на одновременные апдейты одного диалога: двойное нажатие
+# на два слота создало бы две брони. Апдейты без пользователя идут без очереди.
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._user_locks: Dict[int, list] = {}  # user_id → [asyncio.Lock, сколько апдейтов ждут или идут]
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        entry = self._user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# --- Сборка приложения со всеми обработчиками и задачами ---
+# request — свой транспорт к Bot API (нагрузочный тест подставляет поддельный)
+def _application_builder(request=None):
+    builder = Application.builder().token(BOT_TOKEN)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot")
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    return builder
+
+
+def build_application(request=None) -> Application:
+    app = (
+        _application_builder(request)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .persistence(persistence.SQLitePersistence())  # начатые записи переживают перезапуск
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(select_specialization, pattern='^select_spec$')],
@@ -1030,6 +1516,8 @@ def main():
             CallbackQueryHandler(admin_set_price, pattern=r'^admin_price_'),
         ],
         per_message=False,
+        name='booking',
+        persistent=True,
     )
 
     # Регистрация обработчиков
@@ -1039,7 +1527,8 @@ def main():
     app.add_handler(CommandHandler("admin", admin_panel))
 
     # Админские обработчики
-    app.add_handler(CallbackQueryHandler(admin_view_bookings, pattern='^admin_view_bookings$'))
+    app.add_handler(CallbackQueryHandler(admin_view_bookings, pattern=r'^(admin_view_bookings$|admin_bk:)'))
+    app.add_handler(CallbackQueryHandler(admin_bookings_file, pattern=r'^admin_bk_file:'))
     app.add_handler(CallbackQueryHandler(admin_start_booking, pattern='^admin_create_booking$'))
     app.add_handler(CallbackQueryHandler(admin_change_price_menu, pattern='^admin_change_price$'))
     app.add_handler(CallbackQueryHandler(admin_back, pattern='^admin_back$'))
@@ -1047,11 +1536,80 @@ def main():
     # Обработчик ошибок
     app.add_error_handler(error_handler)
 
-    # Запуск фоновой задачи по очистке просроченных броней каждые 5 минут
-    app.job_queue.run_repeating(cleanup_expired_bookings, interval=300, first=10)
+    for group_handlers in app.handlers.values():
+        instrument_handlers(group_handlers)
+
+    # Таймеры оплаты для неоплаченных броней, оставшихся с прошлого запуска
+    restore_booking_expiries(app.job_queue)
+
+    # Напоминания из базы: ближайшее окно сразу после старта, дальше — по расписанию
+    app.job_queue.run_repeating(refill_reminders_job, interval=REMINDER_REFILL_MINUTES * 60, first=1)
+    app.job_queue.run_repeating(flush_users_job, interval=USER_FLUSH_SECONDS, first=USER_FLUSH_SECONDS)
+    return app
+
+
+# --- Главная функция ---
+# --- Входной процесс при BOT_WORKERS > 1: только получает апдейты и раздаёт воркерам ---
+def build_ingress_application(router: sharding.ShardRouter, request=None) -> Application:
+    async def start_ingress(app: Application):
+        if METRICS_PORT:
+            app.bot_data['metrics_server'] = metrics.start_http_server(METRICS_PORT, METRICS_HOST)
+
+    async def stop_workers(app: Application):
+        await asyncio.to_thread(router.stop)
+        if 'metrics_server' in app.bot_data:
+            app.bot_data['metrics_server'].shutdown()
+
+    # Апдейты раздаются по одному, чтобы у каждого пользователя они шли воркеру по порядку
+    app = (
+        _application_builder(request)
+        .job_queue(None)
+        .post_init(start_ingress)
+        .post_shutdown(stop_workers)
+        .build()
+    )
+    app.add_handler(TypeHandler(Update, router.route))
+    return app
+
 
-    logger.info("Бот запущен...")
-    app.run_polling()
+def main():
+    started = time.perf_counter()
+    init_db()
+    db_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    if BOT_WORKERS > 1:
+        db.close_pool()  # миграции уже прошли; дальше с базой работают только воркеры
+        router = sharding.ShardRouter(BOT_WORKERS)
+        router.start()
+        app = build_ingress_application(router)
+        logger.info(f"Воркеров: {BOT_WORKERS}")
+    else:
+        app = build_application()
+    handlers_seconds = time.perf_counter() - started
+
+    logger.info(
+        f"Запуск: импорт {IMPORT_SECONDS * 1000:.0f} мс, "
+        f"БД {db_seconds * 1000:.0f} мс, "
+        f"обработчики и задачи {handlers_seconds * 1000:.0f} мс"
+    )
+
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_URL")
+        logger.info(f"Бот запущен (webhook на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})...")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        logger.info("Бот запущен...")
+        app.run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,149 @@
+# outbox.py — очередь исходящих сообщений с ограничением скорости
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = 25  # сообщений в секунду на всего бота (лимит Telegram ~30)
+PER_CHAT_RATE = 1  # сообщений в секунду в один чат
+WORKERS = 8  # одновременных запросов к Telegram
+MAX_RETRIES = 3  # повторов при сетевых ошибках и 429
+RETRY_BASE_DELAY = 1.0  # секунд, удваивается с каждой попыткой
+
+
+# --- Token bucket: rate токенов в секунду, не больше capacity про запас ---
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _fill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Взять токен; вернуть, сколько секунд подождать, если токена нет
+    def take(self) -> float:
+        self._fill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self) -> bool:
+        self._fill()
+        return self.tokens >= self.capacity
+
+
+# --- Диспетчер: очередь + воркеры, общий и поканальный лимиты, повторы ---
+class MessageDispatcher:
+    def __init__(self, bot, global_rate: float = GLOBAL_RATE, per_chat_rate: float = PER_CHAT_RATE,
+                 workers: int = WORKERS, max_retries: int = MAX_RETRIES):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.workers = workers
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = {}
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._paused_until = 0.0  # после 429 ждут все воркеры, а не только получивший его
+
+    async def start(self):
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"outbox-{i}"))
+        logger.info(f"Очередь сообщений запущена: {self.workers} воркеров")
+
+    # Дождаться отправки всего, что уже в очереди, и остановить воркеры
+    async def stop(self):
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    # Поставить сообщение в очередь; future завершится результатом send_message или ошибкой
+    def submit(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((chat_id, text, kwargs, future, 0))
+        return future
+
+    async def send(self, chat_id: int, text: str, **kwargs):
+        return await self.submit(chat_id, text, **kwargs)
+
+    # Рассылка: вернуть (доставлено, не доставлено)
+    async def broadcast(self, chat_ids, text: str, **kwargs) -> tuple:
+        futures = [self.submit(chat_id, text, **kwargs) for chat_id in chat_ids]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        failed = sum(isinstance(result, Exception) for result in results)
+        return len(results) - failed, failed
+
+    async def _wait_for_tokens(self, chat_id: int):
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+            wait = bucket.take()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            wait = self._global_bucket.take()
+            if not wait:
+                return
+            bucket.tokens += 1  # токен чата вернём, ждём общий лимит
+            await asyncio.sleep(wait)
+
+    def _prune_chat_buckets(self):
+        if len(self._chat_buckets) > 10000:
+            self._chat_buckets = {
+                chat_id: bucket for chat_id, bucket in self._chat_buckets.items() if not bucket.is_full()
+            }
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs, future, attempt = await self._queue.get()
+            try:
+                if future.done():  # отправитель уже не ждёт результата
+                    continue
+                await self._wait_for_tokens(chat_id)
+                try:
+                    result = await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                except RetryAfter as e:
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                    logger.warning(f"Telegram просит подождать {e.retry_after} с (чат {chat_id})")
+                    await self._retry_or_fail(chat_id, text, kwargs, future, attempt, e, delay=0)
+                except BadRequest as e:
+                    # Подкласс NetworkError, но повтор не поможет (чат не найден, текст слишком длинный)
+                    if not future.done():
+                        future.set_exception(e)
+                except (TimedOut, NetworkError) as e:
+                    await self._retry_or_fail(chat_id, text, kwargs, future, attempt, e,
+                                              delay=RETRY_BASE_DELAY * 2 ** attempt)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                self._prune_chat_buckets()
+            finally:
+                self._queue.task_done()
+
+    # Повтор ставится в очередь до task_done, поэтому stop() его дождётся
+    async def _retry_or_fail(self, chat_id, text, kwargs, future, attempt, error, delay: float):
+        if attempt >= self.max_retries:
+            if not future.done():
+                future.set_exception(error)
+            return
+        if delay:
+            await asyncio.sleep(delay)
+        self._queue.put_nowait((chat_id, text, kwargs, future, attempt + 1))
@@ -0,0 +1,207 @@
+# persistence.py — состояние ConversationHandler и context.user_data в той же SQLite-базе,
+# чтобы перезапуск бота не обрывал начатые записи.
+# PTB отдаёт изменения раз в update_interval секунд — они пишутся одной транзакцией,
+# и только ключи, которые отличаются от уже сохранённых. user_data пользователя читается
+# из базы при первом его апдейте после старта, а не вся таблица сразу.
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import db
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_FLUSH_SECONDS = float(os.getenv("PERSISTENCE_FLUSH_SECONDS", "5"))  # как часто писать изменения
+CONVERSATION_TTL_DAYS = 7  # брошенные на полпути диалоги старше этого забываем при старте
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+# --- Запросы к базе (выполняются в потоках db.run) ---
+def load_user_data(user_id: int) -> Dict[str, str]:
+    with db.connection() as conn:
+        rows = conn.execute('SELECT key, value FROM bot_user_data WHERE user_id = ?', (user_id,)).fetchall()
+    return {row['key']: row['value'] for row in rows}
+
+
+def load_conversations(name: str) -> dict:
+    with db.transaction() as conn:
+        conn.execute('''
+            DELETE FROM bot_conversations
+            WHERE name = ? AND updated_at < datetime('now', ?)
+        ''', (name, f'-{CONVERSATION_TTL_DAYS} days'))
+        rows = conn.execute('SELECT key, state FROM bot_conversations WHERE name = ?', (name,)).fetchall()
+    return {tuple(json.loads(row['key'])): row['state'] for row in rows}
+
+
+# users: {user_id: (сохранённые ключи или None, если не читали, новые ключи или None — удалить всё)}
+# conversations: {(name, key): state или None}
+def write_batch(users: dict, conversations: dict):
+    upserts, deletes, cleared = [], [], []
+    for user_id, (stored, new) in users.items():
+        if new is None or stored is None:
+            cleared.append((user_id,))
+            stored = {}
+        for key, value in (new or {}).items():
+            if stored.get(key) != value:
+                upserts.append((user_id, key, value))
+        deletes.extend((user_id, key) for key in stored if key not in (new or {}))
+
+    conversation_upserts, conversation_deletes = [], []
+    for (name, key), state in conversations.items():
+        if state is None:
+            conversation_deletes.append((name, _dumps(list(key))))
+        else:
+            conversation_upserts.append((name, _dumps(list(key)), state))
+
+    changes = len(upserts) + len(deletes) + len(cleared) + len(conversations)
+    if not changes:
+        return 0  # PTB отдаёт всех, кто писал боту, даже если их данные не менялись
+    with db.transaction(immediate=True) as conn:
+        conn.executemany('DELETE FROM bot_user_data WHERE user_id = ?', cleared)
+        conn.executemany('DELETE FROM bot_user_data WHERE user_id = ? AND key = ?', deletes)
+        conn.executemany('''
+            INSERT INTO bot_user_data (user_id, key, value) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value
+        ''', upserts)
+        conn.executemany('DELETE FROM bot_conversations WHERE name = ? AND key = ?', conversation_deletes)
+        conn.executemany('''
+            INSERT INTO bot_conversations (name, key, state) VALUES (?, ?, ?)
+            ON CONFLICT (name, key) DO UPDATE SET state = excluded.state, updated_at = CURRENT_TIMESTAMP
+        ''', conversation_upserts)
+    return changes
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, update_interval: float = PERSISTENCE_FLUSH_SECONDS):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._stored: Dict[int, Dict[str, str]] = {}  # что уже лежит в базе, по пользователям
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._pending_users: Dict[int, Optional[Dict[str, str]]] = {}
+        self._pending_conversations: dict = {}
+        self._stored_conversations: dict = {}  # (name, key) → сохранённое состояние
+        self._writer: Optional[asyncio.Task] = None
+
+    # --- user_data: пусто при старте, каждый пользователь читается при первом апдейте ---
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if user_id in self._stored:
+            return
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            # Параллельный апдейт того же пользователя уже читает базу
+            await loading
+            return
+        loading = self._loading[user_id] = asyncio.ensure_future(db.run(load_user_data, user_id))
+        try:
+            stored = await loading
+        finally:
+            del self._loading[user_id]
+        self._stored[user_id] = stored
+        for key, value in stored.items():
+            user_data.setdefault(key, json.loads(value))  # то, что уже в памяти, новее базы
+
+    async def update_user_data(self, user_id: int, data: dict):
+        encoded = {}
+        for key, value in data.items():
+            try:
+                encoded[str(key)] = _dumps(value)
+            except (TypeError, ValueError):
+                logger.warning(f"user_data[{key!r}] пользователя {user_id} не сохраняется: не JSON")
+        self._pending_users[user_id] = encoded
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int):
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    # --- Диалоги: активных немного, читаются все при старте ---
+    async def get_conversations(self, name: str) -> dict:
+        conversations = await db.run(load_conversations, name)
+        self._stored_conversations.update(((name, key), state) for key, state in conversations.items())
+        return conversations
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        self._pending_conversations[(name, key)] = new_state
+        self._schedule_write()
+
+    # --- Запись: изменения одного прохода PTB собираются в одну транзакцию ---
+    def _schedule_write(self):
+        if self._writer is None or self._writer.done():
+            # Задача стартует после остальных update_* этого прохода (они уже в очереди цикла)
+            self._writer = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        while self._pending_users or self._pending_conversations:
+            users = {
+                user_id: (self._stored.get(user_id), new)
+                for user_id, new in self._pending_users.items()
+            }
+            # ConversationHandler пишет состояние на каждый апдейт, даже если оно то же
+            conversations = {
+                key: state for key, state in self._pending_conversations.items()
+                if self._stored_conversations.get(key) != state
+            }
+            self._pending_users, self._pending_conversations = {}, {}
+            try:
+                written = await db.run(write_batch, users, conversations)
+            except Exception:
+                logger.exception("Не удалось сохранить состояние диалогов, повторим при следующей записи")
+                for user_id, (_, new) in users.items():
+                    self._pending_users.setdefault(user_id, new)
+                for key, state in conversations.items():
+                    self._pending_conversations.setdefault(key, state)
+                return
+            for user_id, (_, new) in users.items():
+                self._stored[user_id] = new if new is not None else {}
+            for key, state in conversations.items():
+                if state is None:
+                    self._stored_conversations.pop(key, None)
+                else:
+                    self._stored_conversations[key] = state
+            if written:
+                logger.debug(f"Persistence: записано изменений {written}")
+
+    async def flush(self):
+        if self._writer is not None:
+            await self._writer
+        await self._write_pending()
+
+    # --- Не храним: chat_data, bot_data, callback_data ---
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
@@ -0,0 +1,142 @@
+# schedule.py — расписание студии: часы работы по дням недели, особые дни,
+# длина слота и залы/преподаватели с вместимостью.
+# Сетка каждого дня считается один раз и хранится битовыми масками: бит i — слот i.
+import os
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Optional
+
+SLOT_MINUTES = int(os.getenv("SLOT_MINUTES", "30"))  # длина слота, минут
+BOOKING_HORIZON_DAYS = int(os.getenv("BOOKING_HORIZON_DAYS", "14"))  # на сколько дней вперёд можно записаться
+
+# Часы работы по дням недели (0 — понедельник); None — выходной
+WEEKLY_HOURS = {
+    0: ('10:00', '20:00'),
+    1: ('10:00', '20:00'),
+    2: ('10:00', '20:00'),
+    3: ('10:00', '20:00'),
+    4: ('10:00', '20:00'),
+    5: ('10:00', '20:00'),
+    6: ('10:00', '20:00'),
+}
+
+# Особые дни: праздник (None) или другие часы работы; важнее WEEKLY_HOURS
+SPECIAL_DAYS = {
+    # '2026-12-31': ('10:00', '16:00'),
+    # '2027-01-01': None,
+}
+
+# Свои часы залов/преподавателей по дням недели (ключ — rooms.key); кого здесь нет,
+# работают в часы студии. Шире часов студии не бывает.
+RESOURCE_HOURS = {
+    # 'small_hall': {0: ('14:00', '20:00'), 2: ('14:00', '20:00')},
+}
+
+# Залы и преподаватели: ключ, название, сколько занятий одновременно, свои часы.
+# Список приходит из таблицы rooms (set_resources), здесь — значение до загрузки.
+RESOURCES = [
+    ('hall', 'Зал', 1, None),
+]
+
+
+def set_resources(rooms):
+    global RESOURCES
+    RESOURCES = [
+        (room['key'], room['name'], room['capacity'], RESOURCE_HOURS.get(room['key']))
+        for room in rooms
+    ]
+    day_plan.cache_clear()
+
+
+def _minutes(value: str) -> int:
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def _label(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def _studio_hours(day: date) -> Optional[tuple]:
+    key = day.isoformat()
+    if key in SPECIAL_DAYS:
+        return SPECIAL_DAYS[key]
+    return WEEKLY_HOURS.get(day.weekday())
+
+
+# --- План дня: сетка слотов и маски открытых слотов каждого зала ---
+class DayPlan:
+    def __init__(self, day: date):
+        self.date = day.isoformat()
+        self.slots = []  # 'HH:MM' по порядку; индекс — номер бита
+        self.resource_masks: Dict[str, int] = {}
+        self.resource_capacity: Dict[str, int] = {}
+        self.open_mask = 0
+        self._index = {}
+
+        hours = _studio_hours(day)
+        if not hours:
+            return
+        start, end = _minutes(hours[0]), _minutes(hours[1])
+        self.slots = [_label(m) for m in range(start, end - SLOT_MINUTES + 1, SLOT_MINUTES)]
+        self._index = {slot: i for i, slot in enumerate(self.slots)}
+
+        for key, _, capacity, resource_hours in RESOURCES:
+            own = resource_hours.get(day.weekday()) if resource_hours is not None else hours
+            if not own:
+                continue
+            own_start, own_end = max(start, _minutes(own[0])), min(end, _minutes(own[1]))
+            mask = 0
+            for i, slot in enumerate(self.slots):
+                slot_start = _minutes(slot)
+                if own_start <= slot_start and slot_start + SLOT_MINUTES <= own_end:
+                    mask |= 1 << i
+            if mask:
+                self.resource_masks[key] = mask
+                self.resource_capacity[key] = capacity
+                self.open_mask |= mask
+
+    # Залы, открытые в этот слот: [(ключ, вместимость)] в порядке RESOURCES
+    def rooms_for_slot(self, slot: str) -> list:
+        i = self._index.get(slot)
+        if i is None:
+            return []
+        bit = 1 << i
+        return [(key, self.resource_capacity[key]) for key, mask in self.resource_masks.items() if mask & bit]
+
+    # Маска слотов, где зал заполнен, по счётчикам {'HH:MM': занято}
+    def full_mask(self, room: str, booked: Dict[str, int]) -> int:
+        capacity = self.resource_capacity.get(room, 0)
+        mask = 0
+        for slot, count in booked.items():
+            i = self._index.get(slot)
+            if i is not None and count >= capacity:
+                mask |= 1 << i
+        return mask
+
+    # Слот свободен, если хоть в одном открытом зале есть место; booked — {зал: {слот: занято}}
+    def free_mask(self, booked: Dict[str, Dict[str, int]]) -> int:
+        mask = 0
+        for room, room_mask in self.resource_masks.items():
+            mask |= room_mask & ~self.full_mask(room, booked.get(room, {}))
+        return mask
+
+    def labels(self, mask: int) -> list:
+        result = []
+        while mask:
+            low = mask & -mask
+            result.append(self.slots[low.bit_length() - 1])
+            mask ^= low
+        return result
+
+
+# Планы зависят только от настроек выше, поэтому считаются один раз на дату
+@lru_cache(maxsize=512)
+def day_plan(date_str: str) -> DayPlan:
+    return DayPlan(datetime.strptime(date_str, '%Y-%m-%d').date())
+
+
+# Даты, на которые можно записаться, начиная с сегодняшней
+def booking_dates(start: date = None) -> list:
+    start = start or date.today()
+    return [start + timedelta(days=i) for i in range(BOOKING_HORIZON_DAYS)]
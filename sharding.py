@@ -0,0 +1,112 @@
+# sharding.py — обработка апдейтов в нескольких процессах (BOT_WORKERS > 1).
+# Входной процесс получает апдейты (polling или webhook) и раскладывает их по воркерам
+# по user_id: диалог и user_data пользователя всегда живут в одном процессе.
+# Очереди — multiprocessing, без внешнего брокера; общая память у процессов — только SQLite.
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+from telegram import Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WORKER_STOP_TIMEOUT = 30  # секунд на то, чтобы воркер дописал очередь и сохранил состояние
+
+routed = metrics.Counter('bot_updates_routed_total', 'Апдейты, переданные воркерам, по номеру воркера')
+
+
+def shard_for(user_id: int, count: int) -> int:
+    return user_id % count
+
+
+# --- Входной процесс: воркеры, их очереди и маршрутизация ---
+class ShardRouter:
+    def __init__(self, count: int):
+        self.count = count
+        # spawn, а не fork: к моменту перезапуска упавшего воркера во входном процессе уже
+        # работают потоки и event loop, а соединения SQLite через fork не переносятся
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue() for _ in range(count)]
+        self.processes = [None] * count
+
+    def _spawn(self, index: int):
+        if self.processes[index] is not None:
+            # Убитый воркер мог умереть внутри get() с захваченной блокировкой очереди —
+            # новый процесс на ней бы завис. Апдейты из старой очереди теряются, как и те,
+            # что воркер обрабатывал в момент падения.
+            self.queues[index].close()
+            self.queues[index].cancel_join_thread()
+            self.queues[index] = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main, args=(index, self.count, self.queues[index]),
+            name=f"bot-worker-{index}", daemon=False,
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Воркер {index} запущен (pid {process.pid})")
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+
+    # Обработчик входного приложения: апдейт уходит воркеру своего пользователя
+    async def route(self, update: Update, context):
+        user = update.effective_user
+        index = shard_for(user.id, self.count) if user else 0
+        if not self.processes[index].is_alive():
+            logger.error(f"Воркер {index} завершился (код {self.processes[index].exitcode}), перезапускаю")
+            self._spawn(index)
+        self.queues[index].put(update.to_dict())
+        routed.inc(shard=index)
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"Воркер {index} не остановился за {WORKER_STOP_TIMEOUT} с, завершаю")
+                process.kill()  # SIGTERM воркер игнорирует
+                process.join()
+        logger.info("Воркеры остановлены")
+
+
+# --- Воркер: обычное приложение бота, апдейты приходят из очереди вместо Telegram ---
+async def serve_updates(app, updates):
+    loop = asyncio.get_running_loop()
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:  # входной процесс останавливается
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+def _worker_main(index: int, count: int, updates):
+    # Ctrl+C и SIGTERM получает вся группа процессов; воркер ждёт, пока входной процесс
+    # отдаст последние апдейты и пришлёт None, — иначе пропадут очередь и несохранённое состояние
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    import music_booking_bot as bot
+
+    bot.set_shard(index, count)
+    bot.init_db()
+    app = bot.build_application()
+    asyncio.run(serve_updates(app, updates))
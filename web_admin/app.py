@@ -1,22 +1,47 @@
 # web_admin/app.py
+import time
+
+_import_started = time.perf_counter()  # для отчёта о времени запуска
+
+import csv
+import hashlib
+import hmac
+import io
+import json
 import os
-import sqlite3
-from flask import Flask, render_template, request, redirect, url_for, session, send_file
+import sys
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import (
+    Flask, render_template, stream_template, request, redirect, url_for, session, send_file,
+    jsonify, abort, flash,
+)
 from datetime import datetime
-import pandas as pd
+
+# Общий слой БД лежит рядом с ботом, на уровень выше
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db  # noqa: E402
+import metrics  # noqa: E402
 
 app = Flask(__name__)
 app.secret_key = "alex7474"  # 🔐 Замени на свой
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "booking.db")  # 👈 Путь к твоей базе от бота
+import_seconds = time.perf_counter() - _import_started
+_db_started = time.perf_counter()
+db.migrate()
+print(
+    f"⏱ Запуск админки (pid {os.getpid()}): импорт {import_seconds * 1000:.0f} мс, "
+    f"БД {(time.perf_counter() - _db_started) * 1000:.0f} мс"
+)
 
 # --- АДМИН ПАРОЛЬ ---
 ADMIN_PASSWORD = "grenader74"  # 🔐 ЗАМЕНИ ЭТО НА СВОЙ ПАРОЛЬ!
 
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # Соединение из общего пула (тот же booking.db, что и у бота)
+    return db.connection()
 
 @app.route('/', methods=['GET', 'POST'])
 def login():
@@ -47,61 +72,493 @@ def logout():
     session.pop('logged_in', None)
     return redirect(url_for('login'))
 
+# --- Метрики процесса админки (SQL, ожидания БД) для Prometheus: после входа или по токену ---
+# Адрес клиента не проверяем: за локальным reverse proxy он всегда 127.0.0.1.
+# Prometheus передаёт токен заголовком Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+@app.route('/metrics')
+def prometheus_metrics():
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    authorized = METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+    if 'logged_in' not in session and not authorized:
+        abort(403)
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# --- Дашборд: фильтры и постраничный вывод ---
+PAGE_SIZE = 100  # строк на странице по умолчанию
+MAX_PAGE_SIZE = 500
+FETCH_CHUNK = 50  # сколько строк забирать из курсора за раз, пока страница отдаётся браузеру
+
+STATUSES = {
+    'confirmed': '✅ Подтверждено',
+    'pending_payment': '⏳ Ожидает оплаты',
+    'cancelled': '❌ Отменено',
+    'expired': '⌛ Истекло',
+}
+SPECIALIZATIONS = ['solo', 'duet', 'ensemble']
+DIRECTIONS = ['percussion', 'strings', 'brass', 'piano', 'vocal', 'mix']
+FILTER_KEYS = ('date_from', 'date_to', 'status', 'specialization', 'direction', 'user')
+
+
+def parse_booking_filters(args) -> dict:
+    filters = {}
+    for key in FILTER_KEYS:
+        value = (args.get(key) or '').strip()
+        if value:
+            filters[key] = value
+    return filters
+
+
+# --- WHERE по фильтрам; под каждое условие есть индекс ---
+def booking_filter_sql(filters: dict) -> tuple:
+    where, params = [], []
+    if 'date_from' in filters:
+        where.append('b.date >= ?')
+        params.append(filters['date_from'])
+    if 'date_to' in filters:
+        where.append('b.date <= ?')
+        params.append(filters['date_to'])
+    for key in ('status', 'specialization', 'direction'):
+        if key in filters:
+            where.append(f'b.{key} = ?')
+            params.append(filters[key])
+    if 'user' in filters:
+        user = filters['user'].lstrip('@')
+        if user.isdigit():
+            where.append('b.user_id = ?')
+            params.append(int(user))
+        else:
+            where.append('b.user_id IN (SELECT user_id FROM users WHERE username = ?)')
+            params.append(user)
+    return where, params
+
+
+# --- Курсор страницы: последняя показанная (date, time_slot, id) ---
+def parse_cursor(value: str):
+    try:
+        date, time_slot, booking_id = value.split('|')
+        return date, time_slot, int(booking_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+# --- Страница броней: строки читаются из курсора по мере рендера шаблона ---
+class BookingPage:
+    def __init__(self, filters: dict, cursor=None, limit: int = PAGE_SIZE):
+        self.filters = filters
+        self.cursor = cursor
+        self.limit = limit
+        self.next_cursor = None  # заполняется, когда страница дочитана и есть продолжение
+
+    def __iter__(self):
+        where, params = booking_filter_sql(self.filters)
+        if self.cursor:
+            where.append('(b.date, b.time_slot, b.id) < (?, ?, ?)')
+            params.extend(self.cursor)
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+        params.append(self.limit + 1)  # лишняя строка — признак следующей страницы
+
+        with get_db() as conn:
+            cursor = conn.execute(f'''
+                SELECT
+                    b.id,
+                    b.user_id,
+                    u.username,
+                    u.first_name,
+                    b.specialization,
+                    b.direction,
+                    b.instrument,
+                    b.date,
+                    b.time_slot,
+                    b.status,
+                    b.price
+                FROM bookings b
+                LEFT JOIN users u ON b.user_id = u.user_id
+                {where_sql}
+                ORDER BY b.date DESC, b.time_slot DESC, b.id DESC
+                LIMIT ?
+            ''', params)
+            shown = 0
+            last = None
+            while True:
+                rows = cursor.fetchmany(FETCH_CHUNK)
+                if not rows:
+                    return
+                for row in rows:
+                    if shown == self.limit:
+                        self.next_cursor = f"{last['date']}|{last['time_slot']}|{last['id']}"
+                        return
+                    yield row
+                    last = row
+                    shown += 1
+
+
 @app.route('/dashboard')
 def dashboard():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''
-        SELECT 
-            b.id, 
-            u.username, 
-            u.first_name,
-            b.specialization, 
-            b.direction, 
-            b.instrument, 
-            b.date, 
-            b.time_slot, 
-            b.status, 
-            b.price
-        FROM bookings b
-        LEFT JOIN users u ON b.user_id = u.user_id
-        ORDER BY b.date DESC, b.time_slot DESC
-    ''')
-    bookings = c.fetchall()
-    conn.close()
-
-    return render_template('index.html', bookings=bookings)
+    filters = parse_booking_filters(request.args)
+    try:
+        limit = max(1, min(int(request.args.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE))
+    except ValueError:
+        limit = PAGE_SIZE
+    cursor = parse_cursor(request.args.get('cursor'))
+    page = BookingPage(filters, cursor, limit)
+
+    # Шаблон отдаётся по частям: первые строки уходят в браузер, пока читаются следующие
+    return app.response_class(stream_template(
+        'index.html',
+        bookings=page,
+        filters=filters,
+        limit=limit,
+        is_first_page=cursor is None,
+        statuses=STATUSES,
+        specializations=SPECIALIZATIONS,
+        directions=DIRECTIONS,
+    ))
+
+# --- Экспорт: строки читаются из курсора пачками, в памяти не копятся ---
+EXPORT_CHUNK = 1000
+EXPORT_COLUMNS = [
+    ('u.username', 'Имя пользователя'),
+    ('u.first_name', 'Имя'),
+    ('b.specialization', 'Специализация'),
+    ('b.direction', 'Направление'),
+    ('b.instrument', 'Инструмент'),
+    ('b.date', 'Дата'),
+    ('b.time_slot', 'Время'),
+    ('b.status', 'Статус'),
+    ('b.price', 'Цена'),
+]
+EXPORT_FORMATS = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+}
+# Потоков выгрузки меньше, чем соединений в пуле, — запросам страниц админки всегда что-то остаётся
+EXPORT_WORKERS = max(1, min(int(os.getenv("EXPORT_WORKERS", "2")), db.DB_POOL_SIZE - 1))
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "booking_exports")
+EXPORT_CACHE_TTL_SECONDS = 24 * 60 * 60  # файлы старше суток удаляются (по новым данным они уже не отдаются)
+EXPORT_JOB_STALE_SECONDS = 10 * 60  # задача без прогресса дольше — процесс, который её вёл, умер
+
+_export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+
+# Пачки читаются по курсору (date, time_slot, id), каждая — своим соединением из пула:
+# пока пачка пишется в файл и сохраняется прогресс, соединение свободно для других запросов
+def iter_export_rows(filters: dict, on_progress=None):
+    columns = ', '.join(column for column, _ in EXPORT_COLUMNS)
+    done = 0
+    last = None
+    while True:
+        where, params = booking_filter_sql(filters)
+        if last:
+            where.append('(b.date, b.time_slot, b.id) < (?, ?, ?)')
+            params.extend(last)
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+        params.append(EXPORT_CHUNK)
+        with get_db() as conn:
+            rows = conn.execute(f'''
+                SELECT {columns}, b.date, b.time_slot, b.id
+                FROM bookings b
+                LEFT JOIN users u ON b.user_id = u.user_id
+                {where_sql}
+                ORDER BY b.date DESC, b.time_slot DESC, b.id DESC
+                LIMIT ?
+            ''', params).fetchall()
+        for row in rows:
+            yield tuple(row)[:len(EXPORT_COLUMNS)]
+        done += len(rows)
+        if on_progress and rows:
+            on_progress(done)
+        if len(rows) < EXPORT_CHUNK:
+            return
+        last = tuple(rows[-1])[-3:]
+
+
+def count_export_rows(filters: dict) -> int:
+    where, params = booking_filter_sql(filters)
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+    with get_db() as conn:
+        return conn.execute(f'SELECT COUNT(*) FROM bookings b {where_sql}', params).fetchone()[0]
+
+
+# --- Excel: write-only книга пишется прямо в файл ---
+def write_export_xlsx(filters: dict, file, on_progress=None):
+    # openpyxl тяжёлый, а выгружают редко — грузим только здесь, а не в каждом воркере при старте
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Бронирования')
+    sheet.append([title for _, title in EXPORT_COLUMNS])
+    for row in iter_export_rows(filters, on_progress):
+        sheet.append(row)
+    workbook.save(file)
+
+
+# --- CSV: пишется в файл пачками по мере чтения из базы ---
+def iter_export_csv(filters: dict, on_progress=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    buffer.write('\ufeff')  # BOM, чтобы Excel открыл UTF-8 без вопросов
+    writer.writerow([title for _, title in EXPORT_COLUMNS])
+    for i, row in enumerate(iter_export_rows(filters, on_progress), start=1):
+        writer.writerow(row)
+        if i % EXPORT_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def write_export_csv(filters: dict, file, on_progress=None):
+    for chunk in iter_export_csv(filters, on_progress):
+        file.write(chunk.encode('utf-8'))
+
+
+# --- Кэш выгрузок: ключ — фильтры + формат + версии данных ---
+# Версии броней и пользователей растут на каждое изменение (триггеры в db.py),
+# поэтому повторная выгрузка того же самого отдаётся готовым файлом, пока данные не изменились.
+def export_cache_key(filters: dict, fmt: str) -> str:
+    with get_db() as conn:
+        max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM bookings').fetchone()[0]
+        bookings_version = db.get_data_version(conn, 'bookings')
+        users_version = db.get_data_version(conn, 'users')
+    fingerprint = json.dumps({'filters': filters, 'format': fmt}, sort_keys=True, ensure_ascii=False)
+    raw = f"{fingerprint}|{max_id}|{bookings_version}|{users_version}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+
+def export_cache_path(cache_key: str, fmt: str) -> str:
+    return os.path.join(EXPORT_CACHE_DIR, f"{cache_key}.{fmt}")
+
+
+def prune_export_cache():
+    cutoff = time.time() - EXPORT_CACHE_TTL_SECONDS
+    try:
+        names = os.listdir(EXPORT_CACHE_DIR)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        path = os.path.join(EXPORT_CACHE_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+    # Задачи живут столько же, сколько их файлы: каждый клик по выгрузке добавляет строку
+    with get_db() as conn:
+        conn.execute(
+            "DELETE FROM export_jobs WHERE updated_at < datetime('now', ?)",
+            (f'-{EXPORT_CACHE_TTL_SECONDS} seconds',),
+        )
+
+
+# Собрать файл выгрузки в кэше; пишется во временный файл и переименовывается целиком
+def build_export_file(filters: dict, fmt: str, path: str, on_progress=None):
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as file:
+            if fmt == 'csv':
+                write_export_csv(filters, file, on_progress)
+            else:
+                write_export_xlsx(filters, file, on_progress)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# --- Фоновые задачи выгрузки: состояние в export_jobs, видно любому процессу админки ---
+def create_export_job(cache_key: str, fmt: str) -> str:
+    job_id = uuid.uuid4().hex
+    with get_db() as conn:
+        conn.execute(
+            'INSERT INTO export_jobs (id, cache_key, format) VALUES (?, ?, ?)',
+            (job_id, cache_key, fmt),
+        )
+    return job_id
+
+
+# Файл уже в кэше — задача сразу готова, число строк берём у той, что его собрала
+def create_cached_export_job(cache_key: str, fmt: str) -> str:
+    job_id = uuid.uuid4().hex
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO export_jobs (id, cache_key, format, state, rows_done, rows_total)
+            SELECT ?, ?, ?, 'done', COALESCE(MAX(rows_done), 0), MAX(rows_done)
+            FROM export_jobs WHERE cache_key = ? AND state = 'done'
+        ''', (job_id, cache_key, fmt, cache_key))
+    return job_id
+
+
+def update_export_job(job_id: str, **fields):
+    assignments = ', '.join(f"{key} = ?" for key in fields)
+    with get_db() as conn:
+        conn.execute(
+            f"UPDATE export_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (*fields.values(), job_id),
+        )
+
+
+def get_export_job(job_id: str):
+    with get_db() as conn:
+        job = conn.execute('''
+            SELECT *, (julianday('now') - julianday(updated_at)) * 86400 AS idle_seconds
+            FROM export_jobs WHERE id = ?
+        ''', (job_id,)).fetchone()
+    if job is None:
+        return None
+    job = dict(job)
+    if job['state'] in ('queued', 'running') and job['idle_seconds'] > EXPORT_JOB_STALE_SECONDS:
+        job['state'] = 'failed'
+        job['error'] = 'Выгрузка прервалась, запустите её ещё раз'
+    return job
+
+
+# Та же выгрузка уже собирается — второй клик подключается к ней, а не запускает новую
+def find_running_export_job(cache_key: str):
+    with get_db() as conn:
+        row = conn.execute('''
+            SELECT id FROM export_jobs
+            WHERE cache_key = ? AND state IN ('queued', 'running')
+              AND updated_at >= datetime('now', ?)
+            ORDER BY created_at DESC LIMIT 1
+        ''', (cache_key, f'-{EXPORT_JOB_STALE_SECONDS} seconds')).fetchone()
+    return row['id'] if row else None
+
+
+def run_export_job(job_id: str, filters: dict, fmt: str, path: str):
+    try:
+        update_export_job(job_id, state='running', rows_total=count_export_rows(filters))
+        progress = {'rows_done': 0}
+
+        def on_progress(done: int):
+            progress['rows_done'] = done
+            update_export_job(job_id, rows_done=done)
+
+        build_export_file(filters, fmt, path, on_progress)
+        update_export_job(job_id, state='done', rows_done=progress['rows_done'])
+        prune_export_cache()
+    except Exception as e:
+        app.logger.exception(f"Выгрузка {job_id} не удалась")
+        update_export_job(job_id, state='failed', error=str(e))
+
+
+def start_export_job(filters: dict, fmt: str) -> str:
+    cache_key = export_cache_key(filters, fmt)
+    path = export_cache_path(cache_key, fmt)
+    if os.path.exists(path):
+        os.utime(path)  # востребованный файл живёт дольше
+        return create_cached_export_job(cache_key, fmt)
+    job_id = find_running_export_job(cache_key)
+    if job_id:
+        return job_id
+    job_id = create_export_job(cache_key, fmt)
+    _export_executor.submit(run_export_job, job_id, filters, fmt, path)
+    return job_id
+
+
+def export_filename(fmt: str) -> str:
+    return f"booking_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+
+
+def export_job_status(job: dict) -> dict:
+    status = {
+        'id': job['id'],
+        'state': job['state'],
+        'format': job['format'],
+        'rows_done': job['rows_done'],
+        'rows_total': job['rows_total'],
+        'progress': 100 if job['state'] == 'done' else (
+            int(job['rows_done'] * 100 / job['rows_total']) if job['rows_total'] else 0),
+        'error': job['error'],
+    }
+    if job['state'] == 'done':
+        status['download_url'] = url_for('export_job_download', job_id=job['id'])
+    return status
+
+
+@app.route('/export/jobs', methods=['POST'])
+def export_job_create():
+    if 'logged_in' not in session:
+        return redirect(url_for('login'))
+
+    filters = parse_booking_filters(request.form)
+    fmt = request.form.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        fmt = 'xlsx'
+    job_id = start_export_job(filters, fmt)
 
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(export_job_status(get_export_job(job_id))), 202
+    return redirect(url_for('export_job_page', job_id=job_id))
+
+
+@app.route('/export/jobs/<job_id>')
+def export_job_page(job_id):
+    if 'logged_in' not in session:
+        return redirect(url_for('login'))
+
+    job = get_export_job(job_id)
+    if job is None:
+        abort(404)
+    return render_template('export_job.html', job=export_job_status(job))
+
+
+@app.route('/export/jobs/<job_id>/status')
+def export_job_status_json(job_id):
+    if 'logged_in' not in session:
+        return jsonify({'error': 'unauthorized'}), 401
+
+    job = get_export_job(job_id)
+    if job is None:
+        return jsonify({'error': 'not found'}), 404
+    return jsonify(export_job_status(job))
+
+
+@app.route('/export/jobs/<job_id>/download')
+def export_job_download(job_id):
+    if 'logged_in' not in session:
+        return redirect(url_for('login'))
+
+    job = get_export_job(job_id)
+    if job is None or job['state'] != 'done':
+        abort(404)
+    path = export_cache_path(job['cache_key'], job['format'])
+    if not os.path.exists(path):  # кэш почистили — собираем заново
+        flash("Файл выгрузки устарел, запустите её ещё раз", "error")
+        return redirect(url_for('dashboard'))
+    return send_file(
+        path,
+        as_attachment=True,
+        download_name=export_filename(job['format']),
+        mimetype=EXPORT_FORMATS[job['format']],
+    )
+
+
+# --- Быстрый экспорт по ссылке: из кэша, если файл уже собран, иначе через фоновую задачу ---
 @app.route('/export')
 def export_excel():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
 
-    conn = get_db()
-    df = pd.read_sql_query('''
-        SELECT 
-            u.username AS "Имя пользователя",
-            u.first_name AS "Имя",
-            b.specialization AS "Специализация",
-            b.direction AS "Направление",
-            b.instrument AS "Инструмент",
-            b.date AS "Дата",
-            b.time_slot AS "Время",
-            b.status AS "Статус",
-            b.price AS "Цена"
-        FROM bookings b
-        LEFT JOIN users u ON b.user_id = u.user_id
-        ORDER BY b.date DESC, b.time_slot DESC
-    ''', conn)
-    conn.close()
-
-    filename = f"booking_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    df.to_excel(filename, index=False, sheet_name='Бронирования')
-
-    return send_file(filename, as_attachment=True)
+    filters = parse_booking_filters(request.args)
+    fmt = request.args.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        fmt = 'xlsx'
+    path = export_cache_path(export_cache_key(filters, fmt), fmt)
+
+    if not os.path.exists(path):
+        return redirect(url_for('export_job_page', job_id=start_export_job(filters, fmt)))
+    return send_file(
+        path,
+        as_attachment=True,
+        download_name=export_filename(fmt),
+        mimetype=EXPORT_FORMATS[fmt],
+    )
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
@@ -0,0 +1,100 @@
+# webhook_client.py — локальная проверка webhook-режима: шлёт боту Update JSON,
+# как это делает Telegram. Чтобы бот и отвечал не в Telegram, запустите его с заглушкой
+# Bot API — см. fake_bot_api.py.
+#
+#   python webhook_client.py --secret S command start
+#   python webhook_client.py --secret S callback select_spec
+#   python webhook_client.py --secret S --count 200 --users 50 command start
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+_update_ids = count(int(time.time()))
+
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}",
+            "language_code": "ru"}
+
+
+def make_message_update(user_id: int, text: str) -> dict:
+    message = {
+        "message_id": next(_update_ids) % 1_000_000,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+        "from": make_user(user_id),
+        "text": text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def make_callback_update(user_id: int, data: str) -> dict:
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": make_user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bot", "username": "bot"},
+                "text": "...",
+            },
+        },
+    }
+
+
+def post_update(url: str, update: dict, secret: str = None) -> int:
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отправить боту Update JSON на webhook")
+    parser.add_argument("kind", choices=["command", "text", "callback"])
+    parser.add_argument("value", help="команда без '/', текст сообщения или callback_data")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default=None)
+    parser.add_argument("--user", type=int, default=100000, help="id первого пользователя")
+    parser.add_argument("--users", type=int, default=1, help="сколько разных пользователей")
+    parser.add_argument("--count", type=int, default=1, help="сколько апдейтов отправить")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    def build(i: int) -> dict:
+        user_id = args.user + i % args.users
+        if args.kind == "callback":
+            return make_callback_update(user_id, args.value)
+        text = f"/{args.value}" if args.kind == "command" else args.value
+        return make_message_update(user_id, text)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        statuses = list(executor.map(lambda i: post_update(args.url, build(i), args.secret), range(args.count)))
+    elapsed = time.perf_counter() - started
+
+    by_status = {}
+    for status in statuses:
+        by_status[status] = by_status.get(status, 0) + 1
+    print(f"Отправлено {args.count} за {elapsed:.2f} с ({args.count / elapsed:.0f}/с), ответы: {by_status}")
+
+
+if __name__ == '__main__':
+    main()